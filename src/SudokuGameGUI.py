@@ -2,6 +2,8 @@ from Tkinter import Canvas, Frame, BOTH, CENTER
 from ttk import Treeview
 import tkMessageBox
 import sys
+import time
+from board import decode_board, encode_board, pack_rows, unpack_rows
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
@@ -9,6 +11,7 @@ MARGIN = 20  # Pixels around the board
 SIDE = 50  # Width of every board cell.
 WIDTH = HEIGHT = MARGIN * 2 + SIDE * 9  # Height and width of the game board
 TOTAL_WIDTH = WIDTH + 180
+FLASH_TIME = 0.3  # Seconds a wrong guess is shown in red
 
 
 class SudokuUI(Frame):
@@ -23,8 +26,9 @@ class SudokuUI(Frame):
         self.parent = parent
 
         self.row, self.col = -1, -1
-        self.new_entry = None
-        self.previous_guess = None
+        self.new_entries = []
+        self.previous_guesses = []
+        self.fail_until = 0
 
         self.game_state = 0
 
@@ -124,7 +128,7 @@ class SudokuUI(Frame):
         Handle solution number entry."""
 
         if self.row >= 0 and self.col >= 0 and event.char in "123456789" and self.game_state == 1:
-            self.new_entry = (self.row, self.col, int(event.char))
+            self.new_entries.append((self.row, self.col, int(event.char)))
             self.col, self.row = -1, -1
             self.__draw_puzzle()
             self.__draw_cursor()
@@ -158,9 +162,9 @@ class SudokuUI(Frame):
         the player about his life decisions.
 
         :param root:
-        :param board:
+        :param board: packed board, None if the board has been updated through the delta of changed cells
         :param new_game_state:
-        :return entered value:
+        :return entered values as a list of (row, column, value), None if nothing was entered:
         """
         return_val = None
 
@@ -174,30 +178,34 @@ class SudokuUI(Frame):
                 self.game_state = new_game_state
             return return_val
 
-        # If previous guess was not correct flash it red
-        if self.previous_guess is not None and board[self.previous_guess[0]][self.previous_guess[1]] != \
-                self.previous_guess[2]:
-            row, col, _ = self.previous_guess
-            x0 = MARGIN + col * SIDE + 1
-            y0 = MARGIN + row * SIDE + 1
-            x1 = MARGIN + (col + 1) * SIDE - 1
-            y1 = MARGIN + (row + 1) * SIDE - 1
-            self.canvas.create_rectangle(x0, y0, x1, y1, fill="red", tags="fail")
-        else:
+        # Unpack the new board before comparing it against the previous guess
+        if board is not None:
+            self.game.update_board(board)
+
+        # If previous guesses were not correct flash them red
+        failed = [guess for guess in self.previous_guesses if self.game.board[guess[0]][guess[1]] != guess[2]]
+        if failed:
+            self.canvas.delete("fail")
+            for row, col, _ in failed:
+                x0 = MARGIN + col * SIDE + 1
+                y0 = MARGIN + row * SIDE + 1
+                x1 = MARGIN + (col + 1) * SIDE - 1
+                y1 = MARGIN + (row + 1) * SIDE - 1
+                self.canvas.create_rectangle(x0, y0, x1, y1, fill="red", tags="fail")
+            self.fail_until = time.time() + FLASH_TIME
+        elif time.time() >= self.fail_until:
             self.canvas.delete("fail")
 
-        # Initiate return value to none, update the board and draw it
-        self.game.update_board(board)
         self.__draw_puzzle()
         root.update()
 
-        # If user has entered anything in between, write it into the return value and previous guess and return
-        if self.new_entry is not None:
-            return_val = self.new_entry
-            self.previous_guess = self.new_entry
-            self.new_entry = None
+        # If user has entered anything in between, write it into the return value and previous guesses and return
+        if self.new_entries:
+            return_val = self.new_entries
+            self.previous_guesses = self.new_entries
+            self.new_entries = []
         else:
-            self.previous_guess = None
+            self.previous_guesses = []
 
         return return_val
 
@@ -209,7 +217,25 @@ class SudokuBoard(object):
     """
 
     def __init__(self, board):
-        self.board = self.__create_board(board)
+        self.board = self.__create_board(SudokuBoard.decode(board))
+
+    @staticmethod
+    def decode(encoded_board):
+        """
+        Decodes a board from its packed wire format, 4 bits per cell.
+        :param encoded_board: board as sent by the server
+        :return: 9x9 list of digits
+        """
+        return unpack_rows(decode_board(encoded_board))
+
+    @staticmethod
+    def encode(board):
+        """
+        Encodes a 9x9 list of digits into the packed wire format.
+        :param board: 9x9 list of digits
+        :return: board as sent by the server
+        """
+        return encode_board(pack_rows(board))
 
     def __create_board(self, input_board):
         if len(input_board) != 9:
@@ -225,7 +251,9 @@ class SudokuBoard(object):
 
         return input_board
 
-    def update_board(self, input_board):
+    def update_board(self, encoded_board):
+        input_board = SudokuBoard.decode(encoded_board)
+
         if len(input_board) != 9:
             raise SudokuError("There must be 9 rows to the board")
 
@@ -239,6 +267,14 @@ class SudokuBoard(object):
 
         self.board = input_board
 
+    def apply_changes(self, cells):
+        """
+        Applies the cells changed since the last update.
+        :param cells: list of (row, column, value)
+        """
+        for row, col, value in cells:
+            self.board[row][col] = value
+
 
 class SudokuError(Exception):
     """
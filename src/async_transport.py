@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import resource
+import struct
+import threading
+
+LOG = logging.getLogger()
+
+# Every frame is a 4 byte big endian length followed by a UTF-8 JSON object.
+# Requests are {"id": n, "method": name, "args": [...]}, without the session token for methods that take one.
+# Responses are {"id": n, "result": ...} or {"id": n, "error": message}.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024  # Largest request accepted, bigger ones close the connection
+
+# Session methods of CompetitiveSudoku reachable through the transport, all of them take the token first
+SESSION_METHODS = frozenset(["get_games_list", "list_games", "create_game", "join_game", "make_guess",
+                             "make_guesses", "get_game_state", "get_state_since", "quit_game", "quit_server"])
+
+
+def encode_frame(message):
+    """
+    Encodes a message into a length prefixed frame
+    :param message: JSON serializable message
+    :return: bytes of the frame
+    """
+    body = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Reads the next frame from the stream
+    :param reader: asyncio stream reader
+    :return: the decoded message, None once the stream has ended
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        length, = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME:
+            raise ValueError("Frame of %d bytes is too big" % length)
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(body.decode("utf-8"))
+
+
+class AsyncTransport(threading.Thread):
+    """
+    Serves the session methods of CompetitiveSudoku over length prefixed JSON frames on asyncio streams.
+    Runs its own event loop in a thread next to the Pyro request loop and drives the same Games and Game objects.
+    Idle connections cost a socket and a coroutine rather than a thread, and wait_for_change waits on a game
+    watcher instead of blocking a thread.
+    Needs Python 3.7 or newer, and the games in this process: waiting on games of a shard would block the loop.
+    """
+
+    def __init__(self, sudoku, host, port, max_wait):
+        """
+        :param sudoku: the CompetitiveSudoku object whose sessions are served
+        :param host: address to listen on
+        :param port: port to listen on
+        :param max_wait: longest a client may wait in wait_for_change, in seconds
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sudoku = sudoku
+        self.host = host
+        self.port = port
+        self.max_wait = max_wait
+        self.connections = 0
+
+    def run(self):
+        # Every connection is a file descriptor, allow as many as the hard limit does
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=1024)
+        LOG.info("Async transport listening on %s:%d" % (self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves one client. Requests are handled concurrently, so a pending wait_for_change does not hold up
+        the client's other calls. Sessions started on the connection end when it closes.
+        """
+        self.connections += 1
+        tokens = set()
+        pending = set()
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except (ValueError, ConnectionError) as e:
+                    LOG.debug("Dropping async client: %s" % str(e))
+                    break
+                if request is None:
+                    break
+                task = asyncio.ensure_future(self.handle_request(request, tokens, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            self.connections -= 1
+            for task in list(pending):
+                task.cancel()
+            for token in tokens:
+                try:
+                    self.sudoku.quit_server(token)
+                except ValueError:
+                    pass  # Already quit or expired
+            writer.close()
+
+    async def handle_request(self, request, tokens, writer):
+        """
+        Calls the requested method and writes back its result or error
+        """
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            method = request["method"]
+            args = request.get("args", [])
+            if method == "login":
+                token = self.sudoku.login(*args)
+                if token is not None:
+                    tokens.add(token)
+                result = token
+            elif method == "wait_for_change":
+                result = await self.wait_for_change(*args)
+            elif method in SESSION_METHODS:
+                result = getattr(self.sudoku, method)(*args)
+                if method == "quit_server":
+                    tokens.discard(args[0])
+            else:
+                raise ValueError("Unknown method %r" % method)
+            response = {"id": request_id, "result": result}
+        except Exception as e:
+            response = {"id": request_id, "error": "%s: %s" % (type(e).__name__, str(e))}
+        writer.write(encode_frame(response))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def wait_for_change(self, token, version, timeout):
+        """
+        Same as CompetitiveSudoku.wait_for_change, but waits on a game watcher without blocking the loop
+        """
+        user = self.sudoku._session(token)
+        user._renew_lease()
+        game = user.game
+        version = int(version)
+        timeout = min(max(float(timeout), 0), self.max_wait)
+
+        loop = asyncio.get_running_loop()
+        changed = loop.create_future()
+
+        def watcher(_):
+            loop.call_soon_threadsafe(lambda: changed.done() or changed.set_result(None))
+
+        if game.watch(version, watcher):
+            try:
+                await asyncio.wait_for(changed, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                game.unwatch(watcher)
+        return game.get_state_since(version)
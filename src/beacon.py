@@ -0,0 +1,197 @@
+import logging
+import os
+import struct
+import threading
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_IP, IP_MULTICAST_LOOP, IP_MULTICAST_TTL
+
+LOG = logging.getLogger()
+
+BEACON_MAGIC = b"SDKU"
+BEACON_VERSION = 1
+# magic, version, send interval in ms, players, open seats, games, recent RPC latency in us, CPU use in
+# per mille of one core, URI length, name length, followed by the URI and the name in UTF-8
+BEACON_HEADER = struct.Struct("!4sBHIIIIHHB")
+MAX_BEACON = 1024  # Largest beacon a listener has to expect
+
+# Beacons are sent often while the load changes and ever less often while it stays the same
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 5.0
+
+LATENCY_WEIGHT = 0.1  # Weight of the latest call in the moving average of the RPC latency
+
+
+def process_tree(pid):
+    """
+    Returns the pid and the pids of all the descendants of a process, as the shards and puzzle generators of a server
+    """
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError):
+            continue  # Gone in the meantime
+        children.setdefault(int(fields[1]), []).append(int(name))
+
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pid):
+    """
+    Returns the CPU time in seconds a process and its descendants have used, read from /proc.
+    Without /proc only the calling process is counted.
+    """
+    if not os.path.isdir("/proc"):
+        return sum(os.times()[:2])
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    cpu = 0.0
+    for member in process_tree(pid):
+        try:
+            with open("/proc/%d/stat" % member) as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError):
+            continue  # Gone in the meantime
+        # utime and stime are the 14th and 15th fields, the first two are cut off with the command name
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+    return cpu
+
+
+def truncate_utf8(text, limit):
+    """
+    Encodes the text in UTF-8 and cuts it down to at most limit bytes, without splitting a character
+    """
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    if len(text) <= limit:
+        return text
+    return text[:limit].decode("utf-8", "ignore").encode("utf-8")
+
+
+def encode_beacon(uri, name, players, open_seats, games, latency, cpu, interval):
+    """
+    Packs a server announcement
+    :param uri: Pyro URI of the server
+    :param name: name of the server
+    :param players: players in games
+    :param open_seats: seats free in the games on the lobby
+    :param games: number of games
+    :param latency: recent RPC latency in seconds
+    :param cpu: CPU use as a share of one core
+    :param interval: seconds until the next beacon at the latest
+    :return: the beacon as bytes
+    """
+    uri = str(uri)
+    if not isinstance(uri, bytes):
+        uri = uri.encode("utf-8")
+    name = truncate_utf8(name, 255)
+    return BEACON_HEADER.pack(BEACON_MAGIC, BEACON_VERSION, min(int(interval * 1000), 0xFFFF), players, open_seats,
+                              games, min(int(latency * 1e6), 0xFFFFFFFF), min(int(cpu * 1000), 0xFFFF), len(uri),
+                              len(name)) + uri + name
+
+
+def decode_beacon(data):
+    """
+    Unpacks a server announcement
+    :param data: bytes received
+    :return: dict with uri, name, players, open_seats, games, latency and cpu as passed to encode_beacon and
+    interval in seconds
+    :raise ValueError: if the data is not a beacon of a known version
+    """
+    if len(data) < BEACON_HEADER.size:
+        raise ValueError("Beacon too short")
+    magic, version, interval, players, open_seats, games, latency, cpu, uri_length, name_length = \
+        BEACON_HEADER.unpack_from(data)
+    if magic != BEACON_MAGIC or version != BEACON_VERSION:
+        raise ValueError("Not a beacon of version %d" % BEACON_VERSION)
+    if len(data) != BEACON_HEADER.size + uri_length + name_length:
+        raise ValueError("Beacon of the wrong length")
+
+    uri_end = BEACON_HEADER.size + uri_length
+    return {
+        "uri": data[BEACON_HEADER.size:uri_end].decode("utf-8"),
+        "name": data[uri_end:].decode("utf-8"),
+        "players": players,
+        "open_seats": open_seats,
+        "games": games,
+        "latency": latency / 1e6,
+        "cpu": cpu / 1000.0,
+        "interval": interval / 1000.0,
+    }
+
+
+class LatencyMeter(object):
+    """
+    Moving average of how long calls take
+    """
+
+    def __init__(self):
+        self.average = 0.0
+
+    def record(self, seconds):
+        self.average += LATENCY_WEIGHT * (seconds - self.average)
+
+
+class Announcer(threading.Thread):
+    """
+    Announces the server to a multicast group with binary beacons sent from a single socket.
+    While the load stays the same, the interval between beacons doubles up to MAX_INTERVAL; any change
+    brings it back to MIN_INTERVAL. Every beacon carries the interval, so listeners know when to expect the next.
+    """
+
+    def __init__(self, uri, name, mc_addr, load, latency, ttl=1):
+        """
+        :param uri: Pyro URI of the server
+        :param name: name of the server
+        :param mc_addr: multicast group address as tuple (mc_host, mc_port)
+        :param load: callable returning (players, open seats, games) of the server
+        :param latency: LatencyMeter of the server's calls
+        :param ttl: time to live of the beacons
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.uri = uri
+        self.name = name
+        self.mc_addr = mc_addr
+        self.load = load
+        self.latency = latency
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, 1)  # Enable loop-back multicast
+        if self.sock.getsockopt(IPPROTO_IP, IP_MULTICAST_TTL) != ttl:
+            self.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, ttl)
+
+    def run(self):
+        interval = MIN_INTERVAL
+        last_load = None
+        # The CPU use of the shards and puzzle generators counts as well, they are child processes
+        pid = os.getpid()
+        last_cpu, last_time = cpu_seconds(pid), time.time()
+        while True:
+            try:
+                load = tuple(self.load())
+            except Exception as e:
+                LOG.error("Cannot read the server load: %s" % str(e))
+                load = last_load or (0, 0, 0)
+            interval = MIN_INTERVAL if load != last_load else min(interval * 2, MAX_INTERVAL)
+            last_load = load
+
+            cpu, now = cpu_seconds(pid), time.time()
+            # Falls when a child process exits, its time is no longer counted
+            cpu_share = max(cpu - last_cpu, 0) / max(now - last_time, 1e-3)
+            last_cpu, last_time = cpu, now
+
+            beacon = encode_beacon(self.uri, self.name, load[0], load[1], load[2], self.latency.average, cpu_share,
+                                   interval)
+            try:
+                self.sock.sendto(beacon, self.mc_addr)
+            except Exception as e:
+                LOG.error("Cannot send multicast beacon: %s" % str(e))
+            time.sleep(interval)
@@ -0,0 +1,109 @@
+import random
+import struct
+import timeit
+from argparse import ArgumentParser
+
+import Pyro4.errors
+import Pyro4.util
+
+from board import decode_board, encode_board
+from game import Game, STATE_FULL
+from puzzles import PuzzleBank
+from registry import IdAllocator
+
+__DESC = "Compares the RPC serializers on the size and encode/decode time of get_state responses"
+
+# Serializers Pyro can be configured with, those that are not installed are skipped
+SERIALIZERS = ("serpent", "json", "marshal", "msgpack")
+
+_STATE_HEADER = struct.Struct("!BIB41sB")  # kind, version, game state, packed board, number of players
+_PLAYER = struct.Struct("!BiB")  # name length, score, id length, followed by the name and the id
+
+
+def encode_state(state):
+    """
+    Packs a full get_state response with struct, as a lower bound for what a custom codec could achieve
+    :return: bytes
+    """
+    kind, version, board, names_scores, game_state = state
+    parts = [_STATE_HEADER.pack(kind, version, game_state, bytes(decode_board(board)), len(names_scores))]
+    for name, score, player_id in names_scores:
+        name, player_id = name.encode("utf-8"), player_id.encode("ascii")
+        parts.append(_PLAYER.pack(len(name), score, len(player_id)) + name + player_id)
+    return b"".join(parts)
+
+
+def decode_state(data):
+    """
+    Unpacks a response packed by encode_state
+    """
+    kind, version, game_state, board, players = _STATE_HEADER.unpack_from(data)
+    names_scores = []
+    offset = _STATE_HEADER.size
+    for _ in range(players):
+        name_length, score, id_length = _PLAYER.unpack_from(data, offset)
+        offset += _PLAYER.size
+        name = data[offset:offset + name_length].decode("utf-8")
+        offset += name_length
+        player_id = data[offset:offset + id_length].decode("ascii")
+        offset += id_length
+        names_scores.append((name, score, player_id))
+    return [kind, version, encode_board(bytearray(board)), names_scores, game_state]
+
+
+def sample_state(puzzles, players, moves):
+    """
+    Plays a game for a while and returns its full state
+    :param puzzles: PuzzleBank to take the board from
+    :param players: number of players in the game
+    :param moves: number of moves made
+    """
+    rng = random.Random(1)
+    game = Game(players, puzzles.get(0))
+    ids = IdAllocator()
+    player_ids = [ids.allocate() for _ in range(players)]
+    for i, player_id in enumerate(player_ids):
+        game.add_player(player_id, "player%d" % i)
+    for _ in range(moves):
+        x, y = rng.randrange(9), rng.randrange(9)
+        value = game.solution.get(x, y) if rng.random() < 0.8 else rng.randint(1, 9)
+        game.make_move(rng.choice(player_ids), x, y, value)
+    return game.get_state()
+
+
+def codecs():
+    """
+    Returns (name, encode, decode) of every available serializer and of the struct codec
+    """
+    found = []
+    for name in SERIALIZERS:
+        try:
+            serializer = Pyro4.util.get_serializer(name)
+        except Pyro4.errors.SerializeError:
+            print("%-8s not available" % name)
+            continue
+        found.append((name, lambda data, s=serializer: s.serializeData(data)[0],
+                      lambda data, s=serializer: s.deserializeData(data)))
+    found.append(("struct", encode_state, decode_state))
+    return found
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__DESC)
+    parser.add_argument("-pl", "--players", help="Number of players in the game", type=int, default=4)
+    parser.add_argument("-m", "--moves", help="Number of moves made before the state is taken", type=int,
+                        default=40)
+    parser.add_argument("-n", "--number", help="Encodes and decodes per timing run", type=int, default=10000)
+    parser.add_argument("-pz", "--puzzles", help="Puzzle file", default="solutions.txt")
+    args = parser.parse_args()
+
+    state = sample_state(PuzzleBank.load(args.puzzles), args.players, args.moves)
+    assert state[0] == STATE_FULL
+
+    print("%-8s %8s %12s %12s" % ("codec", "bytes", "encode us", "decode us"))
+    for name, encode, decode in codecs():
+        data = encode(state)
+        # Best of three runs, the others are disturbed by whatever else the machine does
+        encode_time = min(timeit.repeat(lambda: encode(state), number=args.number, repeat=3)) / args.number
+        decode_time = min(timeit.repeat(lambda: decode(data), number=args.number, repeat=3)) / args.number
+        print("%-8s %8d %12.2f %12.2f" % (name, len(data), encode_time * 1e6, decode_time * 1e6))
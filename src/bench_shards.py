@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+__DESC = "Runs the load generator against the server with different numbers of game shards and compares the " \
+         "throughput, the latency of the guesses and the threads the server needs"
+
+
+def run(shards, args):
+    """
+    Runs loadgen.py against a server with the given number of shards
+    :return: the JSON report of the run
+    """
+    loadgen = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadgen.py")
+    handle, output = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    command = [sys.executable, loadgen, "-c", str(args.clients), "-s", str(args.seconds), "-t", str(args.think),
+               "--python", args.python, "--server-args", "%s -sh %d" % (args.server_args, shards), "-o", output]
+    if args.long_poll:
+        command.append("--long-poll")
+    if args.threadpool is not None:
+        command += ["--threadpool", str(args.threadpool)]
+    try:
+        subprocess.check_call(command)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__DESC)
+    parser.add_argument("-sh", "--shards", help="Shard counts to compare, 0 runs the games in the server process",
+                        type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("-c", "--clients", help="Number of simulated clients", type=int, default=40)
+    parser.add_argument("-s", "--seconds", help="How long to run the load for every shard count", type=float,
+                        default=10)
+    parser.add_argument("-t", "--think", help="Mean seconds a client thinks before each guess", type=float,
+                        default=0)
+    parser.add_argument("-lp", "--long-poll", help="Clients wait for changes with wait_for_change like the client",
+                        action="store_true")
+    parser.add_argument("--python", help="Interpreter to start the server with", default=sys.executable)
+    parser.add_argument("--server-args", help="Extra arguments for server.py, as one string", default="-g 0")
+    parser.add_argument("--threadpool", help="Pyro worker threads of the server and of every shard", type=int)
+    args = parser.parse_args()
+
+    print("%6s %10s %10s %10s %10s %8s %8s" % ("shards", "calls/s", "guesses/s", "p50 ms", "p99 ms", "cpu %",
+                                               "threads"))
+    for shards in args.shards:
+        report = run(shards, args)
+        guesses = report["methods"]["make_guesses"]
+        print("%6d %10.0f %10.0f %10.1f %10.1f %8.0f %8d" % (
+            shards, report["totals"]["throughput"], guesses["throughput"], guesses["p50_ms"], guesses["p99_ms"],
+            report["server"]["cpu_percent"], report["server"]["threads_peak"]))
@@ -0,0 +1,137 @@
+import base64
+
+CELLS = 81
+PACKED_SIZE = (CELLS + 1) // 2  # Two 4 bit cells per byte
+
+
+def pack_rows(rows):
+    """
+    Packs a 9x9 board of digits 0-9 into 41 bytes, two cells per byte.
+    :param rows: 9x9 list of digits
+    :return: bytearray
+    """
+    cells = bytearray(PACKED_SIZE)
+    i = 0
+    for row in rows:
+        for digit in row:
+            if i & 1:
+                cells[i >> 1] |= digit << 4
+            else:
+                cells[i >> 1] |= digit
+            i += 1
+    return cells
+
+
+def unpack_rows(cells):
+    """
+    Unpacks a 41 byte board into a 9x9 list of digits.
+    :param cells: packed board
+    :return: 9x9 list of digits
+    """
+    cells = bytearray(cells)
+    rows = []
+    for x in range(9):
+        row = []
+        for y in range(9):
+            i = x * 9 + y
+            if i & 1:
+                row.append(cells[i >> 1] >> 4)
+            else:
+                row.append(cells[i >> 1] & 0x0F)
+        rows.append(row)
+    return rows
+
+
+def encode_board(cells):
+    """
+    Encodes a packed board for the wire, as an ascii string every serializer can carry.
+    """
+    return base64.b64encode(bytes(cells)).decode("ascii")
+
+
+def decode_board(encoded):
+    """
+    Decodes a board received from the wire into the packed representation.
+    """
+    return bytearray(base64.b64decode(encoded))
+
+
+def _index(x, y):
+    """
+    Returns the number of a cell, counting row by row
+    :raise ValueError: if the cell is not on the board
+    """
+    if not (0 <= x < 9 and 0 <= y < 9):
+        raise ValueError("No cell (%r, %r) on the board" % (x, y))
+    return x * 9 + y
+
+
+class PackedBoard(object):
+    """
+    Sudoku board stored as 4 bits per cell, 81 cells in 41 bytes.
+    """
+    __slots__ = ("cells",)
+
+    def __init__(self, cells=None):
+        """
+        :param cells: packed board to take over, an empty board if not given
+        """
+        if cells is None:
+            cells = bytearray(PACKED_SIZE)
+        if len(cells) != PACKED_SIZE:
+            raise ValueError("A packed board has to be %d bytes long" % PACKED_SIZE)
+        self.cells = cells
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Creates a packed board from a 9x9 list of digits.
+        """
+        return cls(pack_rows(rows))
+
+    @classmethod
+    def decode(cls, encoded):
+        """
+        Creates a packed board from its wire encoding.
+        """
+        return cls(decode_board(encoded))
+
+    def get(self, x, y):
+        """
+        Returns the digit in the given cell
+        :param x: row number
+        :param y: column number
+        :raise ValueError: if the cell is not on the board
+        """
+        i = _index(x, y)
+        if i & 1:
+            return self.cells[i >> 1] >> 4
+        return self.cells[i >> 1] & 0x0F
+
+    def set(self, x, y, value):
+        """
+        Writes a digit into the given cell
+        :param x: row number
+        :param y: column number
+        :param value: digit 0-9
+        :raise ValueError: if the cell is not on the board or the value is not a digit
+        """
+        i = _index(x, y)
+        if not 0 <= value <= 9:
+            raise ValueError("Not a digit: %r" % (value,))
+        if i & 1:
+            self.cells[i >> 1] = (self.cells[i >> 1] & 0x0F) | (value << 4)
+        else:
+            self.cells[i >> 1] = (self.cells[i >> 1] & 0xF0) | value
+
+    def to_rows(self):
+        """
+        Returns the board as a 9x9 list of digits.
+        """
+        return unpack_rows(self.cells)
+
+    def encode(self):
+        """
+        Returns the wire encoding of the board.
+        """
+        return encode_board(self.cells)
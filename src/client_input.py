@@ -1,5 +1,6 @@
 # encoding: utf-8
-from Tkinter import Frame, Button, BOTH, Entry, Label, OptionMenu, StringVar, CENTER
+from Tkinter import Frame, Button, BOTH, Entry, Label, OptionMenu, StringVar, CENTER, Checkbutton, IntVar, \
+    Scrollbar, VERTICAL, NS
 from ttk import Treeview
 import tkMessageBox
 import logging
@@ -106,6 +107,7 @@ class ConnectionUI(Frame):
     """
     server_uri = None
     nickname = None
+    auto_selected = None
 
     def __init__(self, parent):
         Frame.__init__(self, parent)
@@ -115,7 +117,8 @@ class ConnectionUI(Frame):
 
     def __initUI(self):
         """
-        Initialize UI with server list and a connection button."""
+        Initialize UI with server list and a connection button.
+        Servers are listed best first, the URI of each row is its item id."""
 
         self.parent.title('Sudoku server selection')
         self.pack(fill=BOTH, expand=1)
@@ -133,12 +136,14 @@ class ConnectionUI(Frame):
                                                  command=self.__select_preset)
         self.entry_nickname_options.grid(row=1, column=1, padx=(0, 15))
 
-        self.server_list = Treeview(self, columns=('server', 'games'))
+        self.server_list = Treeview(self, columns=('server', 'players', 'ping'))
         self.server_list['show'] = 'headings'
         self.server_list.heading('server', text='Server name')
-        self.server_list.column('server', width=250, anchor=CENTER)
-        self.server_list.heading('games', text='Games')
-        self.server_list.column('games', width=100, anchor=CENTER)
+        self.server_list.column('server', width=190, anchor=CENTER)
+        self.server_list.heading('players', text='Players')
+        self.server_list.column('players', width=80, anchor=CENTER)
+        self.server_list.heading('ping', text='Ping')
+        self.server_list.column('ping', width=80, anchor=CENTER)
         self.server_list.grid(row=2, column=0, columnspan=2, rowspan=2, padx=20, pady=(10, 0))
 
         self.connect_lobby = Button(self, text='Join server', command=self.__connect_server)
@@ -172,8 +177,8 @@ class ConnectionUI(Frame):
         selected_server = None
 
         if current_item is not None and current_item.strip() != '':
-            # Select game column value from item values dictionary.
-            selected_server = self.server_list.item(current_item)['values'][2]
+            # The item id is the server URI.
+            selected_server = current_item
             LOG.debug('Player wishes to join server ' + str(selected_server))
 
             if selected_server is not None:
@@ -193,33 +198,43 @@ class ConnectionUI(Frame):
 
     def populate_server_list(self, servers):
         """
-        Method to re-populate the server list every poll.
-        Additionally retains the focused line during polling.
-        :param servers:
+        Method to re-populate the server list every poll, best server first.
+        Retains the focused line during polling. Until the user picks a server, the best one is selected.
+        :param servers: ServerTable of the discovered servers
         """
         previous_selection = self.server_list.selection()
-        prev_item = None
-        if len(previous_selection) > 0:
-            prev_item = self.server_list.item(previous_selection[0])
+        prev_uri = previous_selection[0] if len(previous_selection) > 0 else None
+        if prev_uri is not None and prev_uri == self.auto_selected:
+            prev_uri = None
 
         self.server_list.delete(*self.server_list.get_children())
-        for server in servers.keys():
-            nr_players, server_name = servers[server]
-            self.server_list.insert('', 'end', values=(str(server_name), str(nr_players), str(server)))
-
-        if prev_item is not None:
-            for item in self.server_list.get_children():
-                if self.server_list.item(item) == prev_item:
-                    self.server_list.selection_set(item)
-                    self.server_list.focus(item)
+        for server in servers.ranked():
+            ping = '%d ms' % (server['rtt'] * 1000) if server['rtt'] is not None and server['reachable'] else '-'
+            self.server_list.insert('', 'end', iid=server['uri'],
+                                    values=(server['name'], str(server['players']), ping))
+
+        if prev_uri is not None and self.server_list.exists(prev_uri):
+            self.server_list.selection_set(prev_uri)
+            self.server_list.focus(prev_uri)
+        else:
+            children = self.server_list.get_children()
+            self.auto_selected = children[0] if len(children) > 0 else None
+            if self.auto_selected is not None:
+                self.server_list.selection_set(self.auto_selected)
+                self.server_list.focus(self.auto_selected)
 
 
 class LobbyUI(Frame):
     """
     Sudoku multiplayer lobby UI class.
     In case of incorrect inputs error messages are shown.
+    The game list is loaded page by page, another page is requested when the list is scrolled to the end.
     """
     action = None
+    pages = 1
+    has_more = False
+    filters = None
+    version = None
 
     def __init__(self, parent):
         Frame.__init__(self, parent)
@@ -240,7 +255,15 @@ class LobbyUI(Frame):
         self.lobby_list.column('room', width=250, anchor=CENTER)
         self.lobby_list.heading('players', text='Players')
         self.lobby_list.column('players', width=100, anchor=CENTER)
-        self.lobby_list.grid(row=1, column=0, columnspan=2, rowspan=2, padx=20, pady=(10, 0))
+        self.lobby_list.grid(row=1, column=0, columnspan=2, rowspan=2, padx=(20, 0), pady=(10, 0))
+
+        self.lobby_scroll = Scrollbar(self, orient=VERTICAL, command=self.lobby_list.yview)
+        self.lobby_scroll.grid(row=1, column=2, rowspan=2, sticky=NS, padx=(0, 20), pady=(10, 0))
+        self.lobby_list.configure(yscrollcommand=self.__lobby_scrolled)
+
+        self.free_only = IntVar(self)
+        Checkbutton(self, text='Only rooms with free seats', variable=self.free_only,
+                    command=self.__toggle_free_only).grid(row=0, column=0, columnspan=2, pady=(10, 0))
 
         self.connect_lobby = Button(self, text='Joining Sudoku\n Solving Session', command=self.__connect_lobby)
         self.connect_lobby.grid(row=3, column=1, pady=(0, 10))
@@ -261,8 +284,8 @@ class LobbyUI(Frame):
         selected_id = None
 
         if current_item is not None and current_item.strip() != '':
-            # Select game column value from item values dictionary.
-            selected_id = self.lobby_list.item(current_item)['values'][0]
+            # The item id is the room id, values would turn ids that look like numbers into numbers.
+            selected_id = current_item
             LOG.debug('Player wishes to join game ' + str(selected_id))
 
             if selected_id is not None:
@@ -292,26 +315,44 @@ class LobbyUI(Frame):
         if max_ok:
             self.action = ('create', max_count)
 
-    def populate_lobby_list(self, servers):
+    def __lobby_scrolled(self, first, last):
+        """
+        Moves the scrollbar and asks for one more page once the end of the list comes into view."""
+        self.lobby_scroll.set(first, last)
+        if float(last) >= 1.0 and self.has_more:
+            self.has_more = False
+            self.pages += 1
+            self.version = None
+
+    def __toggle_free_only(self):
         """
-        Method to re-populate the lobby list every poll.
+        Switch between listing all rooms and only rooms with free seats."""
+        self.filters = {'min_free': 1} if self.free_only.get() else None
+        self.pages = 1
+        self.version = None
+
+    def populate_lobby_list(self, servers, next_cursor=None, version=None):
+        """
+        Method to re-populate the lobby list whenever the lobby has changed.
         Additionally retains the focused line during polling.
         :param servers:
+        :param next_cursor: cursor of the page after the loaded ones, None if everything has been loaded
+        :param version: lobby version the list corresponds to
         """
         previous_selection = self.lobby_list.selection()
-        prev_item = None
-        if len(previous_selection) > 0:
-            prev_item = self.lobby_list.item(previous_selection[0])
+        prev_id = previous_selection[0] if len(previous_selection) > 0 else None
 
         self.lobby_list.delete(*self.lobby_list.get_children())
         for server in servers:
-            self.lobby_list.insert('', 'end', values=(str(server[0]), str(server[1]) + '/' + str(server[2])))
+            self.lobby_list.insert('', 'end', iid=str(server[0]),
+                                   values=(str(server[0]), str(server[1]) + '/' + str(server[2])))
+
+        if prev_id is not None and self.lobby_list.exists(prev_id):
+            self.lobby_list.selection_set(prev_id)
+            self.lobby_list.focus(prev_id)
 
-        if prev_item is not None:
-            for item in self.lobby_list.get_children():
-                if self.lobby_list.item(item) == prev_item:
-                    self.lobby_list.selection_set(item)
-                    self.lobby_list.focus(item)
+        self.has_more = next_cursor is not None
+        self.version = version
 
 
 def initiate_mc_window(root):
@@ -381,14 +422,16 @@ def initiate_lobby(root):
     return room_window
 
 
-def update_lobby(lobby_window, games):
+def update_lobby(lobby_window, games, next_cursor=None, version=None):
     """
     Update lobby list view from games list data.
     :param lobby_window:
     :param games:
+    :param next_cursor:
+    :param version:
     """
 
-    lobby_window.populate_lobby_list(games)
+    lobby_window.populate_lobby_list(games, next_cursor, version)
     lobby_window.update()
 
 
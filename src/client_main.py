@@ -2,13 +2,17 @@ import logging
 import threading
 import time
 import tkMessageBox
+from argparse import ArgumentParser
+from Queue import Queue, Empty
 from Tkinter import Tk
-from socket import socket, AF_INET, SOCK_DGRAM, inet_aton, IPPROTO_IP, IP_ADD_MEMBERSHIP, SOL_SOCKET, SO_REUSEADDR, \
-    SHUT_RDWR, timeout, SHUT_WR
 
 import Pyro4
 
 import SudokuGameGUI
+from beacon import MAX_INTERVAL
+from discovery import ServerTable, BeaconListener, RttProber
+from game import STATE_FULL, STATE_DELTA
+from replication import FAILURE_TIMEOUT
 from client_input import initiate_input, initiate_lobby, update_input, update_lobby, destroy_input_window, \
     destroy_lobby_window, initiate_mc_window, destroy_mc_window
 
@@ -25,9 +29,22 @@ input_refresh_thread = None
 input_data = None
 lobby_data = None
 
+# Last known game state, kept up to date from full and delta responses
+game_version = 0
+game_scores = []
+game_progression = 0
+
 hard_exit = False
 
-__SERVERS = {}
+__SERVERS = ServerTable()
+
+GAME_WAIT_TIMEOUT = 10  # Seconds a long-poll for game changes may block on the server
+UI_REFRESH_INTERVAL = 0.05  # Seconds between game window redraws while no change has arrived
+LOBBY_PAGE_SIZE = 50  # Games fetched per lobby page, more pages are loaded when scrolling to the end
+# Seconds a backup is looked for after the server failed: it takes over once it has missed the server for
+# FAILURE_TIMEOUT and is heard of with its first beacon, a beacon of another backup may take MAX_INTERVAL
+FAILOVER_TIMEOUT = FAILURE_TIMEOUT + MAX_INTERVAL
+FAILOVER_BACKOFF = (0.25, 2.0)  # First and longest pause between rounds of looking for a backup, in seconds
 
 
 def refresh_input(input_window):
@@ -77,15 +94,32 @@ def refresh_lobby(room_window, user):
     global lobby_data
     global hard_exit
 
+    # Re-read every page the user has scrolled into, following the cursors.
+    # Nothing is re-read or redrawn while the lobby version stays the same.
     games = []
+    cursor = None
     try:
-        games = user.get_games_list()
+        for page_nr in range(room_window.pages):
+            if page_nr == 0:
+                page, cursor, version = user.list_games(None, LOBBY_PAGE_SIZE, room_window.filters,
+                                                        room_window.version)
+            else:
+                page, cursor, _ = user.list_games(cursor, LOBBY_PAGE_SIZE, room_window.filters)
+            if page is None:
+                games = None
+                break
+            games.extend(page)
+            if cursor is None:
+                break
     except Exception as err:
         tkMessageBox.showwarning("Connection error", str(err))
         hard_exit = True
         return
 
-    update_lobby(room_window, games)
+    if games is not None:
+        update_lobby(room_window, games, cursor, version)
+    else:
+        room_window.update()
 
     lobby_data = room_window.action
 
@@ -127,37 +161,54 @@ def refresh_game_state(sudoku_ui, game_state, user_id):
     """
     Calls the Sudoku UI game board visual state update.
     :param sudoku_ui:
-    :param game_state:
+    :param game_state: full, delta or unchanged state response
     :param user_id:
     :return:
     """
-    board, scores, game_progression = game_state
+    global game_version, game_scores, game_progression
+
+    board = None
+    if game_state is None or game_state[1] < game_version:
+        # Nothing new arrived, or the long-poll answer is older than the response to our own guess
+        kind = None
+    else:
+        kind, game_version = game_state[0], game_state[1]
+
+    if kind == STATE_FULL:
+        board, game_scores, game_progression = game_state[2], game_state[3], game_state[4]
+    elif kind == STATE_DELTA:
+        cells, scores, game_progression = game_state[2], game_state[3], game_state[4]
+        sudoku_ui.game.apply_changes(cells)
+        if scores is not None:
+            game_scores = scores
+
     keep_playing = True
 
-    board_changed = sudoku_ui.update_board(root, board, scores, game_progression)
+    board_changed = sudoku_ui.update_board(root, board, game_scores, game_progression)
 
     if game_progression == 2:
-        sudoku_ui.show_winner(scores[0], user_id)
+        sudoku_ui.show_winner(game_scores[0], user_id)
         keep_playing = False
 
     return board_changed, keep_playing
 
 
-def refresh_game(sudoku_ui, user, board_changed=None):
+def refresh_game(sudoku_ui, user, watcher, board_changed=None):
     """
     Gets updated game state from server to refresh the visual game state if needed.
     :param sudoku_ui:
     :param user:
-    :param board_changed:
+    :param watcher: game watcher thread delivering the long-poll responses
+    :param board_changed: list of guesses entered since the last refresh
     :return loop ending boolean, board change for the next iteration:
     """
     global hard_exit
 
     try:
         if board_changed is not None:
-            game_state = user.make_guess(board_changed[0], board_changed[1], board_changed[2])
+            game_state = user.make_guesses(board_changed)[1]
         else:
-            game_state = user.get_game_state()
+            game_state = watcher.next_state(UI_REFRESH_INTERVAL)
 
     except Exception as err:
         tkMessageBox.showwarning("Connection error", str(err))
@@ -166,7 +217,6 @@ def refresh_game(sudoku_ui, user, board_changed=None):
 
     board_changed, keep_playing = refresh_game_state(sudoku_ui, game_state, user_id)
 
-    time.sleep(0.2)
     return board_changed, keep_playing
 
 
@@ -181,14 +231,18 @@ def refresh_game_loopy(sudoku_ui, user):
     board_changed = None
     keep_playing = True
 
+    watcher = GameWatcher(user, game_version)
+    watcher.start()
+
     while keep_playing:
         if hard_exit:
             sudoku_ui.destroy()
             hard_exit = False
             break
 
-        board_changed, keep_playing = refresh_game(sudoku_ui, user, board_changed)
+        board_changed, keep_playing = refresh_game(sudoku_ui, user, watcher, board_changed)
 
+    watcher.stop()
     sudoku_ui.destroy()
     try:
         user.quit_game()
@@ -266,6 +320,8 @@ def main_sudoku(root, lobby_data, user):
     :param user:
     :return:
     """
+    global game_version, game_scores, game_progression
+
     action, value = lobby_data
     game_state = None
 
@@ -293,10 +349,10 @@ def main_sudoku(root, lobby_data, user):
 
     LOG.debug("The game state is " + str(game_state))
 
-    # First unpack game state into board, scores, game progression indicator
-    board, scores, game_progression = game_state[0], game_state[1], game_state[2]
+    # First unpack game state into version, board, scores, game progression indicator
+    game_version, board, game_scores, game_progression = game_state[1], game_state[2], game_state[3], game_state[4]
 
-    LOG.debug("Scores are " + str(scores))
+    LOG.debug("Scores are " + str(game_scores))
     LOG.debug("Game state is " + str(game_progression))
 
     game = SudokuGameGUI.SudokuBoard(board)
@@ -318,71 +374,149 @@ def on_close():
         hard_exit = True
 
 
-class MulticastDiscoveryThread(threading.Thread):
-    def __init__(self, servers):
-        self._stopevent = threading.Event()
-        threading.Thread.__init__(self)
-
-        self.sock = socket(AF_INET, SOCK_DGRAM)
-
-        try:
-            membership = inet_aton(mc_host) + inet_aton("0.0.0.0")
-
-            self.sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, membership)
-            self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-
-            self.sock.bind(("0.0.0.0", mc_port))
-
-            self.sock.settimeout(1)
-
-            LOG.debug("Socket bound")
-            self.servers = servers
-        except:
-            self.sock.close()
-            exit()
+class SessionProxy(object):
+    """
+    Calls the server's session methods with the session token, so it can be used like a User proxy.
+    If the server cannot be reached, the call is retried on the other servers announced under the same name,
+    which are backups that take over the session. Backups only announce themselves once they have taken over,
+    so they are looked for with growing pauses for up to FAILOVER_TIMEOUT.
+    """
 
-    def run(self):
-        while not self._stopevent.isSet():
+    def __init__(self, sudoku, token, servers=None, server_name=None):
+        """
+        :param sudoku: proxy of the server
+        :param token: session token
+        :param servers: ServerTable of the discovered servers, kept up to date by discovery
+        :param server_name: name the server announces itself with
+        """
+        self.sudoku = sudoku
+        self.token = token
+        self.servers = servers if servers is not None else ServerTable()
+        self.server_name = server_name
+
+    def __getattr__(self, name):
+        def call(*args):
             try:
-                message, address = self.sock.recvfrom(255)
-            except timeout:
-                LOG.debug("No data in multicast")
-                message, address = None, None
-
-            if message:
-                header, content = message.split(";", 1)
+                return getattr(self.sudoku, name)(self.token, *args)
+            except Pyro4.errors.CommunicationError as err:
+                return self.__fail_over(name, args, err)
+        return call
+
+    def __fail_over(self, name, args, err):
+        """
+        Retries a call that failed on the server on the other servers with the same name
+        :param err: error of the failed call, raised if no backup answers in time
+        """
+        failed_uri = str(self.sudoku._pyroUri)
+        deadline = time.time() + FAILOVER_TIMEOUT
+        pause = FAILOVER_BACKOFF[0]
+        while True:
+            for server in self.servers.ranked(self.server_name):
+                uri = server["uri"]
+                if uri == failed_uri:
+                    continue
+                LOG.debug("Failing over to " + uri)
+                proxy = Pyro4.Proxy(uri)
+                try:
+                    result = getattr(proxy, name)(self.token, *args)
+                except Pyro4.errors.CommunicationError:
+                    proxy._pyroRelease()
+                    continue
+                self.sudoku._pyroRelease()
+                self.sudoku = proxy
+                return result
+            if time.time() + pause > deadline:
+                raise err
+            time.sleep(pause)
+            pause = min(pause * 2, FAILOVER_BACKOFF[1])
+
+    def new_connection(self):
+        """
+        Returns a proxy for the same session on a connection of its own.
+        """
+        return SessionProxy(Pyro4.Proxy(self.sudoku._pyroUri), self.token, self.servers, self.server_name)
+
+    def release(self):
+        """
+        Closes the connection to the server.
+        """
+        self.sudoku._pyroRelease()
+
+
+class GameWatcher(threading.Thread):
+    """
+    Long-polls the server for game changes on a connection of its own and queues the responses,
+    so the UI thread never blocks waiting for other players' moves.
+    """
 
-                LOG.debug("Header: " + str(header))
-                LOG.debug("Content: " + str(content))
+    def __init__(self, user, version):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._stopevent = threading.Event()
+        self.user = user
+        self.version = version
+        self.updates = Queue()
 
-                addr, content = content.split(";", 1)
-                name, content = content.split(";", 1)
-                nr_of_players = content.split(";", 1)[0]
-                if addr not in self.servers:
-                    self.servers[addr] = (nr_of_players, name)
+    def run(self):
+        user = self.user.new_connection()
+        try:
+            while not self._stopevent.isSet():
+                game_state = user.wait_for_change(self.version, GAME_WAIT_TIMEOUT)
+                self.version = game_state[1]
+                self.updates.put(game_state)
+        except Exception as err:
+            self.updates.put(err)
+        finally:
+            user.release()
+
+    def next_state(self, timeout):
+        """
+        Returns the next queued state response, None if nothing arrived within the timeout.
+        Errors from the long-poll connection are raised here.
+        :param timeout:
+        """
+        try:
+            game_state = self.updates.get(timeout=timeout)
+        except Empty:
+            return None
 
-        #self.sock.shutdown(SHUT_WR)
-        self.sock.close()
+        if isinstance(game_state, Exception):
+            raise game_state
+        return game_state
 
-    def join(self, timeout=None):
+    def stop(self):
         self._stopevent.set()
-        threading.Thread.join(self, timeout)
 
 
 if __name__ == "__main__":
+    parser = ArgumentParser(description="Competitive Sudoku client")
+    parser.add_argument("-se", "--serializer", help="Serializer for the calls to the server, one the server accepts",
+                        default=Pyro4.config.SERIALIZER)
+    args = parser.parse_args()
+    try:
+        Pyro4.util.get_serializer(args.serializer)
+    except Pyro4.errors.SerializeError as err:
+        parser.error(str(err))
+    Pyro4.config.SERIALIZER = args.serializer
+
     root = Tk()
     root.protocol("WM_DELETE_WINDOW", on_close)
 
     mc_host, mc_port = main_mc_input(root)
 
-    while 1:
-        multicast_thread = MulticastDiscoveryThread(__SERVERS)
-        multicast_thread.start()
+    # Discovery keeps running, so backups taking over a server are known when the session fails over
+    try:
+        multicast_thread = BeaconListener(__SERVERS, (mc_host, mc_port))
+    except Exception as err:
+        LOG.error("Cannot join the multicast group: %s" % str(err))
+        exit()
+    multicast_thread.start()
+    rtt_prober = RttProber(__SERVERS)
+    rtt_prober.start()
 
+    while 1:
         server_uri, user_id = main_input(root)
 
-        multicast_thread.join()
-
         LOG.debug(server_uri)
         LOG.debug(user_id)
 
@@ -394,10 +528,10 @@ if __name__ == "__main__":
         try:
             sudoku = Pyro4.Proxy(server_uri)
 
-            my_uri = sudoku.register(user_id)
+            my_token = sudoku.login(user_id)
 
-            if my_uri:
-                me = Pyro4.Proxy(my_uri)
+            if my_token:
+                me = SessionProxy(sudoku, my_token, __SERVERS, (__SERVERS.get(server_uri) or {}).get("name"))
 
         except Exception as err:
             tkMessageBox.showwarning("Connection error at registration", str(err))
@@ -428,4 +562,6 @@ if __name__ == "__main__":
             # If we got here, then we're ready to play.
             main_sudoku(root, lobby_data, me)
 
+    rtt_prober.join()
+    multicast_thread.join()
     LOG.debug('kthxbye')
@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+from argparse import ArgumentParser
+
+import Pyro4
+
+from discovery import ServerTable, BeaconListener, RttProber
+from games import LOBBY_FULL, LOBBY_DELTA, LOBBY_UNCHANGED
+
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+LOG = logging.getLogger()
+
+SYNC_INTERVAL = 1.0  # Seconds between lobby syncs with every server
+DIRECTORY_ID = "directory"  # Pyro object id, so the directory URI is known from its address alone
+
+
+@Pyro4.expose
+class Directory(object):
+    """
+    Merged lobby of every game server heard on the multicast group.
+    Servers are found by their beacons and dropped with them, their rooms are kept in sync by asking each server
+    for the lobby changes since the version seen last. Clients get the rooms of the whole fleet in one call
+    instead of joining the group and waiting for every server's beacon.
+    """
+
+    def __init__(self, table):
+        """
+        :param table: ServerTable kept up to date by a BeaconListener
+        """
+        self.table = table
+        # uri -> [lobby version of the server, {room_id: (players, max_players)}]
+        self.lobbies = {}
+        # Rooms with free seats, uri -> {room_id: free seats}
+        self.open_rooms = {}
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def _apply(self, uri, changes):
+        """
+        Applies an answer of the server's get_lobby_changes
+        """
+        kind, server_version = changes[0], changes[1]
+        with self.lock:
+            lobby = self.lobbies.setdefault(uri, [None, {}])
+            if kind == LOBBY_UNCHANGED:
+                return
+            rooms = lobby[1]
+            open_rooms = self.open_rooms.setdefault(uri, {})
+            if kind == LOBBY_FULL:
+                rooms.clear()
+                open_rooms.clear()
+                changed = changes[2]
+            elif kind == LOBBY_DELTA:
+                for room_id in changes[3]:
+                    rooms.pop(room_id, None)
+                    open_rooms.pop(room_id, None)
+                changed = changes[2] + changes[4]
+            else:
+                raise ValueError("Unknown lobby answer %r" % kind)
+
+            for room_id, players, max_players in changed:
+                rooms[room_id] = (players, max_players)
+                if players < max_players:
+                    open_rooms[room_id] = max_players - players
+                else:
+                    open_rooms.pop(room_id, None)
+            lobby[0] = server_version
+            self.version += 1
+
+    def _forget(self, uri):
+        """
+        Drops the rooms of a server that is gone
+        """
+        with self.lock:
+            self.open_rooms.pop(uri, None)
+            if self.lobbies.pop(uri, None) is not None:
+                self.version += 1
+
+    def _sync_loop(self):
+        """
+        Keeps the lobbies in sync with the servers in the table, on connections owned by this thread
+        """
+        proxies = {}
+        while True:
+            uris = self.table.uris()
+            for uri in list(proxies.keys()):
+                if uri not in uris:
+                    proxies.pop(uri)._pyroRelease()
+            for uri in list(self.lobbies.keys()):
+                if uri not in uris:
+                    LOG.info("Server %s is gone" % uri)
+                    self._forget(uri)
+
+            for uri in uris:
+                proxy = proxies.get(uri)
+                if proxy is None:
+                    proxy = proxies[uri] = Pyro4.Proxy(uri)
+                    proxy._pyroTimeout = SYNC_INTERVAL
+                lobby = self.lobbies.get(uri)
+                try:
+                    self._apply(uri, proxy.get_lobby_changes(lobby[0] if lobby is not None else None))
+                except Exception as e:
+                    LOG.debug("Cannot sync the lobby of %s: %s" % (uri, str(e)))
+                    proxies.pop(uri)._pyroRelease()
+            time.sleep(SYNC_INTERVAL)
+
+    def get_servers(self):
+        """
+        Returns the known servers best first, as the entries of the server table """
+        return self.table.ranked()
+
+    def get_lobby(self, version=None, free_only=False, limit=None):
+        """
+        Returns the rooms of every server, those on the best servers first
+        :param version: directory version the caller has seen, if it is still current no rooms are sent
+        :param free_only: only return rooms with free seats
+        :param limit: most rooms to return, None for all of them
+        :return: [directory version, list of (server uri, server name, room_id, num_players, max_players)].
+        The list is None if nothing changed since the given version.
+        """
+        servers = self.table.ranked()
+        with self.lock:
+            if version is not None and int(version) == self.version:
+                return [self.version, None]
+            output = []
+            for server in servers:
+                rooms = self.lobbies.get(server["uri"], [None, {}])[1]
+                open_rooms = self.open_rooms.get(server["uri"], {})
+                for room_id, (players, max_players) in rooms.items():
+                    if free_only and room_id not in open_rooms:
+                        continue
+                    output.append((server["uri"], server["name"], room_id, players, max_players))
+                    if limit is not None and len(output) >= int(limit):
+                        return [self.version, output]
+            return [self.version, output]
+
+    def find_seat(self):
+        """
+        Returns (server uri, room_id) of a free seat on the best server that has one, None if there is no free seat
+        """
+        servers = self.table.ranked()
+        with self.lock:
+            for server in servers:
+                open_rooms = self.open_rooms.get(server["uri"])
+                if open_rooms:
+                    # Rooms that are almost full are preferred, so games fill up and start
+                    return server["uri"], min(open_rooms, key=open_rooms.get)
+        return None
+
+    def get_metrics(self):
+        """
+        Returns the size of the merged lobby """
+        with self.lock:
+            return {
+                "servers": len(self.lobbies),
+                "rooms": sum(len(lobby[1]) for lobby in self.lobbies.values()),
+                "open_rooms": sum(len(rooms) for rooms in self.open_rooms.values()),
+                "version": self.version,
+            }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Lobby directory of the Competitive Sudoku servers on a multicast group")
+    parser.add_argument("-mc", "--multicast", help="Multicast group URI", default="239.1.1.1")
+    parser.add_argument("-mcp", "--mcport", help="Multicast group port", type=int, default=7778)
+    parser.add_argument("-host", "--host", help="Pyro host URI", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Pyro host port", type=int, default=7779)
+    args = parser.parse_args()
+
+    table = ServerTable()
+    BeaconListener(table, (args.multicast, args.mcport)).start()
+    # The round trip times rank the servers as seen from the directory
+    RttProber(table).start()
+
+    directory = Directory(table)
+    syncer = threading.Thread(target=directory._sync_loop)
+    syncer.setDaemon(True)
+    syncer.start()
+
+    daemon = Pyro4.Daemon(host=args.host, port=args.port)
+    uri = daemon.register(directory, DIRECTORY_ID)
+    LOG.info("The directory URI is: " + str(uri))
+    daemon.requestLoop()
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, inet_aton, IPPROTO_IP, IP_ADD_MEMBERSHIP, SOL_SOCKET, SO_REUSEADDR, \
+    timeout
+
+import Pyro4
+
+from beacon import MAX_BEACON, decode_beacon
+
+LOG = logging.getLogger()
+
+MISSED_BEACONS = 3  # Beacons a server may miss before it is dropped from the table
+PROBE_INTERVAL = 2.0  # Seconds between round trip probes of every server
+PROBE_TIMEOUT = 1.0  # Seconds a probe may take before the server counts as unreachable
+RTT_WEIGHT = 0.3  # Weight of the latest probe in the moving average of the round trip time
+LOAD_PENALTY = 0.05  # Seconds added to a server's score for every core its CPU use amounts to
+
+
+class ServerTable(object):
+    """
+    Servers heard from by discovery, keyed by their Pyro URI.
+    Every beacon refreshes its server's entry, servers that miss MISSED_BEACONS of the beacons they announced
+    are dropped. Entries are dicts with the fields of a decoded beacon, the time it was "seen" and the measured
+    round trip time "rtt" in seconds, None until the first probe answered.
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.lock = threading.Lock()
+
+    def update(self, beacon, now=None):
+        """
+        Adds or refreshes the server announced by a beacon
+        :param beacon: decoded beacon
+        :param now: time the beacon arrived
+        """
+        entry = dict(beacon)
+        entry["seen"] = time.time() if now is None else now
+        with self.lock:
+            old = self.servers.get(beacon["uri"])
+            entry["rtt"] = old["rtt"] if old is not None else None
+            entry["reachable"] = old["reachable"] if old is not None else True
+            self.servers[beacon["uri"]] = entry
+
+    def expire(self, now=None):
+        """
+        Drops the servers that have missed too many beacons
+        :return: URIs of the dropped servers
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            expired = [uri for uri, entry in self.servers.items()
+                       if now - entry["seen"] > MISSED_BEACONS * entry["interval"]]
+            for uri in expired:
+                del self.servers[uri]
+        for uri in expired:
+            LOG.debug("Server %s went silent" % uri)
+        return expired
+
+    def record_rtt(self, uri, rtt):
+        """
+        Folds a probe into the server's round trip time
+        :param uri: URI of the probed server
+        :param rtt: seconds the probe took, None if it failed
+        """
+        with self.lock:
+            entry = self.servers.get(uri)
+            if entry is None:
+                return
+            if rtt is None:
+                entry["reachable"] = False
+            elif entry["rtt"] is None or not entry["reachable"]:
+                entry["rtt"] = rtt
+                entry["reachable"] = True
+            else:
+                entry["rtt"] += RTT_WEIGHT * (rtt - entry["rtt"])
+                entry["reachable"] = True
+
+    def get(self, uri):
+        """
+        Returns a copy of the server's entry, None if it is not known
+        """
+        with self.lock:
+            entry = self.servers.get(uri)
+            return dict(entry) if entry is not None else None
+
+    def uris(self):
+        with self.lock:
+            return list(self.servers.keys())
+
+    def ranked(self, name=None):
+        """
+        Returns copies of the entries, best server first.
+        Reachable servers come first, then those not probed yet. Within them the server with the lowest sum of
+        round trip time, RPC latency reported in its beacon and a penalty for its CPU use wins.
+        :param name: only return the servers announced under this name
+        """
+        with self.lock:
+            entries = [dict(entry) for entry in self.servers.values() if name is None or entry["name"] == name]
+        return sorted(entries, key=score)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.servers)
+
+
+def score(entry):
+    """
+    Sort key of a server table entry, lower is better
+    """
+    expected = (entry["rtt"] or 0) + entry["latency"] + LOAD_PENALTY * entry["cpu"]
+    return not entry["reachable"], entry["rtt"] is None, expected, entry["players"]
+
+
+class BeaconListener(threading.Thread):
+    """
+    Joins the multicast group and keeps the server table up to date from the beacons it hears
+    """
+
+    def __init__(self, table, mc_addr):
+        """
+        :param table: ServerTable to update
+        :param mc_addr: multicast group address as tuple (mc_host, mc_port)
+        :raise socket.error: if the group cannot be joined
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._stopevent = threading.Event()
+        self.table = table
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        try:
+            membership = inet_aton(mc_addr[0]) + inet_aton("0.0.0.0")
+            self.sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, membership)
+            self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.sock.bind(("0.0.0.0", mc_addr[1]))
+            # Wake up now and then to expire silent servers and notice being stopped
+            self.sock.settimeout(1)
+        except:
+            self.sock.close()
+            raise
+        LOG.debug("Socket bound")
+
+    def run(self):
+        while not self._stopevent.isSet():
+            try:
+                message, address = self.sock.recvfrom(MAX_BEACON)
+            except timeout:
+                message, address = None, None
+            self.table.expire()
+
+            if message:
+                try:
+                    beacon = decode_beacon(message)
+                except ValueError as err:
+                    LOG.debug("Ignoring multicast from %s: %s" % (address[0], str(err)))
+                    continue
+                self.table.update(beacon)
+
+        self.sock.close()
+
+    def join(self, timeout=None):
+        self._stopevent.set()
+        threading.Thread.join(self, timeout)
+
+
+class RttProber(threading.Thread):
+    """
+    Measures the round trip time to every server in the table by calling its ping method.
+    Connects for every probe and disconnects right after, an open connection would hold one of the server's
+    worker threads between probes. The connection is set up before the clock starts, so only the call is timed.
+    """
+
+    def __init__(self, table, interval=PROBE_INTERVAL):
+        """
+        :param table: ServerTable to probe the servers of
+        :param interval: seconds between probes of every server
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._stopevent = threading.Event()
+        self.table = table
+        self.interval = interval
+
+    @staticmethod
+    def probe(uri):
+        """
+        Returns the seconds a ping to the server took, None if it failed
+        """
+        proxy = Pyro4.Proxy(uri)
+        proxy._pyroTimeout = PROBE_TIMEOUT
+        try:
+            try:
+                proxy._pyroBind()
+            except Exception as e:
+                LOG.debug("Cannot reach %s: %s" % (uri, str(e)))
+                return None
+
+            start = time.time()
+            try:
+                proxy.ping()
+            except Exception as e:
+                LOG.debug("Ping to %s failed: %s" % (uri, str(e)))
+                return None
+            return time.time() - start
+        finally:
+            proxy._pyroRelease()
+
+    def run(self):
+        while not self._stopevent.isSet():
+            for uri in self.table.uris():
+                self.table.record_rtt(uri, self.probe(uri))
+            self._stopevent.wait(self.interval)
+
+    def join(self, timeout=None):
+        self._stopevent.set()
+        threading.Thread.join(self, timeout)
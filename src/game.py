@@ -1,42 +1,81 @@
+import numbers
+import sys
+import threading
+import time
+from collections import deque
 
-def read_solution():
+from board import PackedBoard
+
+# Kinds of state responses, every response starts with [kind, version]
+STATE_FULL = 0  # [kind, version, board, names_scores, game_state]
+STATE_DELTA = 1  # [kind, version, changed cells as (x, y, value), names_scores or None, game_state]
+STATE_UNCHANGED = 2  # [kind, version]
+
+HISTORY_SIZE = 128  # Number of recent cell changes kept for delta responses
+
+
+def check_move(move):
     """
-    Reads the Sudoku starting board and solution from a file
+    Checks that a move is an (x, y, value) triple of a cell on the board and a digit 1-9
+    :raise ValueError: if it is not
     """
-    f = open("solutions.txt", "r")
-    solution = [[None]*9 for x in range(0,9)]
-    for i in range(9):
-        row = f.readline().strip()
-        split_row = row.split(" ")
-        for j in range(9):
-            solution[i][j] = int (split_row[j])
-                     
-    f.readline()
-    
-    board = [[None]*9 for x in range(0,9)]
-    for i in range(9):
-        row = f.readline().strip()
-        split_row = row.split(" ")
-        for j in range(9):
-            board[i][j] = int (split_row[j])
-    f.close()
-
-    return solution, board
+    try:
+        x, y, value = move
+    except (TypeError, ValueError):
+        raise ValueError("A move has to be (x, y, value), not %r" % (move,))
+    if not all(isinstance(number, numbers.Integral) for number in (x, y, value)):
+        raise ValueError("Not a move of whole numbers: %r" % (move,))
+    if not (0 <= x < 9 and 0 <= y < 9 and 1 <= value <= 9):
+        raise ValueError("Not a digit on the board: %r" % (move,))
 
 
 class Game:
 
-    def __init__(self, max_players):
+    def __init__(self, max_players, puzzle):
         """
         Creates a new game
         :param max_players: number of players that can play the game at once
+        :param puzzle: tuple of (solution, board) the game is played on
         :return:
         """
-        self.solution, self.board = read_solution()
+        solution, board = puzzle
+        self.solution = PackedBoard.from_rows(solution)
+        self.board = PackedBoard.from_rows(board)
+        # Number of cells that still differ from the solution, kept up to date by make_move
+        self.remaining = sum(1 for i in range(9) for j in range(9) if board[i][j] != solution[i][j])
         self.scores = {}
         self.max_players = int(max_players)
         self.game_state = 0
 
+        # Scoreboard as [name, score, uid] entries, best score first, with the position of every player
+        self.leaderboard = []
+        self.ranks = {}
+        self.names_scores = []
+
+        # Every change to the board, scores or game state bumps the version
+        self.version = 0
+        self.scores_version = 0
+        # Recent cell changes as (version, x, y, value), deltas can be given since history_floor
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.history_floor = 0
+        # Every game has a lock of its own, so moves in different games never contend.
+        # Waiters for the next version are woken up through the condition on the same lock.
+        self.lock = threading.RLock()
+        self.version_changed = threading.Condition(self.lock)
+        # Set once the game has been taken out of the registry, nobody can join it after that
+        self.removed = False
+        # Times of the last change and of the end of the game, used to evict old games
+        self.last_activity = time.time()
+        self.finished_at = None
+        # Called with the game whenever its players or game state change, used by the lobby index
+        self.listener = None
+        # One-off callbacks for the next version, used by waiters that cannot block on the condition
+        self.watchers = []
+        # Set while make_moves applies a batch, the waiters are woken once at its end instead of after every move
+        self.batching = False
+        # Called with every join, move and leave, used to replicate the game
+        self.journal = None
+
     def make_move(self, user_id, x, y, value):
         """
         Processes a player's move
@@ -45,15 +84,126 @@ class Game:
         :param y: column number
         :param value: the digit that the player entered
         :return:
+        :raise ValueError: if the move is not a digit on the board, the game is left as it was
         """
-        if self.valid_move(x, y, value):
-            if self.board[x][y] != value:  # If the move has already been made, ignore it
-                self.board[x][y] = value
-                self.scores[user_id] += 1
-                self.check_game_won()
-            return True
-        self.scores[user_id] -= 1
-        return False
+        check_move((x, y, value))
+        with self.lock:
+            correct = self.valid_move(x, y, value)
+            if correct:
+                if self.board.get(x, y) != value:  # If the move has already been made, ignore it
+                    self.board.set(x, y, value)
+                    self.remaining -= 1
+                    self.add_score(user_id, 1)
+                    self.changed(True)
+                    self.record_cell(x, y, value)
+                    if self.check_game_won():
+                        self.lobby_changed()
+            else:
+                self.add_score(user_id, -1)
+                self.changed(True)
+            self.journal_event("move", user_id, x, y, value)
+            return correct
+
+    def make_moves(self, user_id, moves):
+        """
+        Processes a batch of a player's moves atomically, scoring each like make_move.
+        Every move is checked before any is applied, so a bad move rejects the whole batch. Every move still gets
+        a version of its own, for the deltas and the journal, but waiters are only woken once for the batch.
+        :param user_id: player's id
+        :param moves: list of (x, y, value)
+        :return: [list of make_move results, full state after the whole batch]
+        :raise ValueError: if any of the moves is not a digit on the board, the game is left as it was
+        """
+        with self.lock:
+            for move in moves:
+                check_move(move)
+            version = self.version
+            self.batching = True
+            try:
+                results = [self.make_move(user_id, x, y, value) for x, y, value in moves]
+            finally:
+                self.batching = False
+            if self.version != version:
+                self.wake_waiters()
+            return [results, self.get_state()]
+
+    def add_score(self, user_id, points):
+        """
+        Changes a player's score and moves the player to the right place on the leaderboard
+        :param user_id: player's id
+        :param points: number of points to add, negative to subtract
+        """
+        score = self.scores[user_id] + points
+        self.scores[user_id] = score
+        rank = self.ranks[user_id]
+        self.leaderboard[rank][1] = score
+        self.move_on_leaderboard(rank)
+
+    def move_on_leaderboard(self, rank):
+        """
+        Swaps the entry at the given rank with its neighbours until the leaderboard is sorted again
+        """
+        leaderboard = self.leaderboard
+        entry = leaderboard[rank]
+        while rank > 0 and leaderboard[rank - 1][1] < entry[1]:
+            leaderboard[rank] = leaderboard[rank - 1]
+            self.ranks[leaderboard[rank][2]] = rank
+            rank -= 1
+        while rank < len(leaderboard) - 1 and leaderboard[rank + 1][1] > entry[1]:
+            leaderboard[rank] = leaderboard[rank + 1]
+            self.ranks[leaderboard[rank][2]] = rank
+            rank += 1
+        leaderboard[rank] = entry
+        self.ranks[entry[2]] = rank
+
+    def changed(self, scores_changed=False):
+        """
+        Bumps the version of the game after a change
+        :param scores_changed: whether the scoreboard changed as well
+        """
+        with self.lock:
+            self.version += 1
+            self.last_activity = time.time()
+            if scores_changed:
+                self.scores_version = self.version
+                self.names_scores = [tuple(entry) for entry in self.leaderboard]
+            if not self.batching:
+                self.wake_waiters()
+
+    def wake_waiters(self):
+        """
+        Wakes up the waiters for the next version and calls the watchers. Called with the game's lock held.
+        """
+        self.version_changed.notify_all()
+        if self.watchers:
+            watchers, self.watchers = self.watchers, []
+            for watcher in watchers:
+                watcher(self)
+
+    def lobby_changed(self):
+        """
+        Lets the listener know that the players or the game state have changed
+        """
+        if self.listener is not None:
+            self.listener(self)
+
+    def journal_event(self, kind, *args):
+        """
+        Hands a change to the journal along with the version it brought the game to. Called with the lock held.
+        :param kind: "join", "move" or "leave"
+        :param args: arguments of the change
+        """
+        if self.journal is not None:
+            self.journal(kind, self.version, *args)
+
+    def record_cell(self, x, y, value):
+        """
+        Remembers a cell change of the current version for delta responses
+        """
+        if len(self.history) == self.history.maxlen:
+            # The oldest change is about to be dropped, older versions can only get a full state
+            self.history_floor = self.history[0][0]
+        self.history.append((self.version, x, y, value))
             
     def valid_move(self, x, y, value):
         """
@@ -63,35 +213,53 @@ class Game:
         :param value: the digit that the player entered
         :return:
         """
-        if self.solution[x][y] == value:
+        if self.solution.get(x, y) == value:
             return True
         return False
             
     def check_game_won(self):
         """
-        Checks if the game is over
+        Checks if the game is over and ends it if so
         :return: Returns True, if the game is over and False if it's not
         """
-        game_won = True
-        for i in range(9):
-            for j in range(9):
-                if self.board[i][j] != self.solution[i][j]:
-                    game_won = False
-        if game_won:
-            self.game_state = 2
+        if self.remaining == 0:
+            self.finish()
+            return True
+        return False
 
-    def add_player(self, player_id):
+    def finish(self):
+        """
+        Ends the game
+        """
+        self.game_state = 2
+        self.finished_at = time.time()
+
+    def add_player(self, player_id, name):
         """
         Adds a new player to the game, if possible
         :param player_id:
-        :return:
+        :param name: player's name shown on the scoreboard
+        :return: True if the player has a seat in the game, False if the game is full, gone or the id holds
+        the seat of someone else
         """
-        if len(self.scores) < self.max_players:
-            self.scores[player_id] = 0
-            if len(self.scores) == self.max_players:
-                self.game_state = 1
-            return True
-        return False
+        with self.lock:
+            if self.removed:
+                return False
+            if player_id in self.scores:
+                # Only the player already sitting there may join again
+                return self.leaderboard[self.ranks[player_id]][0] == name
+            if len(self.scores) < self.max_players:
+                self.scores[player_id] = 0
+                self.ranks[player_id] = len(self.leaderboard)
+                self.leaderboard.append([name, 0, player_id])
+                self.move_on_leaderboard(len(self.leaderboard) - 1)
+                if len(self.scores) == self.max_players:
+                    self.game_state = 1
+                self.changed(True)
+                self.lobby_changed()
+                self.journal_event("join", player_id, name)
+                return True
+            return False
 
     def get_num_players(self):
         """
@@ -103,18 +271,131 @@ class Game:
         """
         Removes the given player from the game
         """
-        self.scores.pop(player_id, None)
-        # Check if only one player remains - if so, end the game
-        if self.get_num_players() == 1 and self.game_state == 1:
-            self.game_state = 2
+        with self.lock:
+            if self.scores.pop(player_id, None) is None:
+                return
+            del self.leaderboard[self.ranks.pop(player_id)]
+            for rank, entry in enumerate(self.leaderboard):
+                self.ranks[entry[2]] = rank
+            # Check if only one player remains - if so, end the game
+            if self.get_num_players() == 1 and self.game_state == 1:
+                self.finish()
+            self.changed(True)
+            self.lobby_changed()
+            self.journal_event("leave", player_id)
+
+    def footprint(self):
+        """
+        Estimates the number of bytes the game takes up in memory
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        size += sys.getsizeof(self.board.cells) + sys.getsizeof(self.solution.cells)
+        size += sys.getsizeof(self.history) + sum(sys.getsizeof(change) for change in self.history)
+        for players in (self.scores, self.ranks, self.leaderboard, self.names_scores):
+            size += sys.getsizeof(players)
+        size += sum(sys.getsizeof(entry) for entry in self.leaderboard)
+        size += sum(sys.getsizeof(entry) for entry in self.names_scores)
+        return size
+
+    def snapshot(self):
+        """
+        Returns everything needed to rebuild the game elsewhere, see from_snapshot
+        """
+        with self.lock:
+            return {
+                "max_players": self.max_players,
+                "solution": self.solution.encode(),
+                "board": self.board.encode(),
+                "leaderboard": [list(entry) for entry in self.leaderboard],
+                "game_state": self.game_state,
+                "version": self.version,
+            }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Rebuilds a game from its snapshot. Only the cell changes made after the snapshot can be sent as deltas.
+        :param snapshot: dictionary made by snapshot
+        :return: the game
+        """
+        solution = PackedBoard.decode(snapshot["solution"]).to_rows()
+        board = PackedBoard.decode(snapshot["board"]).to_rows()
+        game = cls(snapshot["max_players"], (solution, board))
+        game.leaderboard = [list(entry) for entry in snapshot["leaderboard"]]
+        game.scores = dict((entry[2], entry[1]) for entry in game.leaderboard)
+        game.ranks = dict((entry[2], rank) for rank, entry in enumerate(game.leaderboard))
+        game.names_scores = [tuple(entry) for entry in game.leaderboard]
+        game.game_state = snapshot["game_state"]
+        if game.game_state == 2:
+            game.finished_at = time.time()
+        game.version = game.scores_version = game.history_floor = snapshot["version"]
+        return game
+
+    def get_state(self):
+        """
+        Returns the current state of the game as a full snapshot
+        """
+        with self.lock:
+            return [STATE_FULL, self.version, self.board.encode(), self.names_scores, self.game_state]
+
+    def get_state_since(self, version):
+        """
+        Returns what changed in the game after the given version
+        :param version: last version the caller has seen
+        :return: an unchanged answer, a delta of the changed cells and scores or a full snapshot if the
+        caller is too far behind
+        """
+        with self.lock:
+            if version == self.version:
+                return [STATE_UNCHANGED, self.version]
+            if version < self.history_floor or version > self.version:
+                return self.get_state()
+
+            cells = []
+            for change_version, x, y, value in reversed(self.history):
+                if change_version <= version:
+                    break
+                cells.append((x, y, value))
+            cells.reverse()
+
+            names_scores = None
+            if self.scores_version > version:
+                names_scores = self.names_scores
+            return [STATE_DELTA, self.version, cells, names_scores, self.game_state]
+
+    def watch(self, version, watcher):
+        """
+        Asks for the watcher to be called with the game once it moves past the given version
+        :param version: last version the caller has seen
+        :param watcher: callback taking the game, called with the game's lock held, must not block
+        :return: False if the game is past the version already and the watcher will not be called
+        """
+        with self.lock:
+            if self.version != version:
+                return False
+            self.watchers.append(watcher)
+            return True
+
+    def unwatch(self, watcher):
+        """
+        Forgets a watcher that has not been called yet
+        """
+        with self.lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
 
-    def get_state(self, players):
+    def wait_for_change(self, version, timeout):
         """
-        Returns the current state of the game
+        Blocks until the game moves past the given version or the timeout expires
+        :param version: last version the caller has seen
+        :param timeout: maximum number of seconds to wait
+        :return: same as get_state_since
         """
-        names_scores = []
-        for uid, score in self.scores.items():
-            name = players.get_player_name(uid)
-            names_scores.append((name, score, uid))
-        names_scores = sorted(names_scores, key=lambda x: x[1], reverse=True)
-        return [self.board, names_scores, self.game_state]
\ No newline at end of file
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.version == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.version_changed.wait(remaining)
+            return self.get_state_since(version)
\ No newline at end of file
@@ -1,35 +1,235 @@
-import uuid
+import itertools
+import threading
+from bisect import bisect_right, insort
+from collections import deque
+from functools import partial
+
 from game import Game
+from reaper import Reaper
+from registry import StripedDict, IdAllocator
+
+MAX_PAGE = 100  # Most lobby rows handed out by a single list_games call
+LOBBY_HISTORY_SIZE = 256  # Number of recent lobby changes kept for lobby diffs
+
+# Kinds of lobby responses, every response starts with [kind, version]
+LOBBY_FULL = 0  # [kind, version, rows]
+LOBBY_DELTA = 1  # [kind, version, added rows, removed room ids, updated rows]
+LOBBY_UNCHANGED = 2  # [kind, version]
+
+# Kinds of lobby changes
+_ADDED, _UPDATED, _REMOVED = range(3)
+
+# Default number of seconds games are kept around
+FINISHED_TTL = 60  # after the game has ended
+EMPTY_TTL = 30  # after the last player has left
+IDLE_TTL = 600  # after the last move, join or leave
+
+
+def matches(game, filters):
+    """
+    Checks a game against lobby filters
+    :param game: the game
+    :param filters: dict with any of min_free (free seats), max_players, min_fill and max_fill (0-1 share of seats
+    taken)
+    :return: True if the game passes all the filters
+    """
+    players = len(game.scores)
+    if "min_free" in filters and game.max_players - players < int(filters["min_free"]):
+        return False
+    if "max_players" in filters and game.max_players != int(filters["max_players"]):
+        return False
+    fill = float(players) / game.max_players if game.max_players else 1.0
+    if "min_fill" in filters and fill < float(filters["min_fill"]):
+        return False
+    if "max_fill" in filters and fill > float(filters["max_fill"]):
+        return False
+    return True
 
 
 class Games:
-    def __init__(self):
-        self.games = {}
+    def __init__(self, puzzles, finished_ttl=FINISHED_TTL, empty_ttl=EMPTY_TTL, idle_ttl=IDLE_TTL):
+        """
+        :param puzzles: puzzle source new games draw their boards from
+        :param finished_ttl: seconds a finished game is kept
+        :param empty_ttl: seconds an empty game is kept
+        :param idle_ttl: seconds a game without any activity is kept
+        """
+        self.games = StripedDict()
+        self.ids = IdAllocator()
+        self.puzzles = puzzles
+        # Finished, empty and idle games are evicted by the reaper once their time to live has passed
+        self.finished_ttl = finished_ttl
+        self.empty_ttl = empty_ttl
+        self.idle_ttl = idle_ttl
+        self.reaper = Reaper(self.reap)
+        self.reaped = {"finished": 0, "empty": 0, "idle": 0}
+        self.bytes_freed = 0
+        # Games shown in the lobby: not empty and not finished, kept up to date by the games themselves.
+        # Every game gets a sequence number at creation, the listed games are kept sorted by it,
+        # which gives the lobby pages a stable order and cursor.
+        self.sequence = itertools.count(1)
+        self.listed = {}
+        self.listed_seqs = []
+        self.index_lock = threading.RLock()
+        # The lobby version is bumped whenever a game is listed, changes or is unlisted. Recent changes are kept
+        # as (version, kind, seq, game_id) so clients can be sent a diff since lobby_floor.
+        self.lobby_version = 0
+        self.lobby_history = deque(maxlen=LOBBY_HISTORY_SIZE)
+        self.lobby_floor = 0
+        # Called with every created, changed and evicted game as a list of [kind, game_id, ...], used to
+        # replicate the games
+        self.journal = None
 
-    def create_game(self, max_players):
+    def create_game(self, max_players, player_id, name, game_id=None):
         """
         Creates a new game and associates it with an id
         :param max_players: maximum number of players in the game
+        :param player_id: id of the player creating the game
+        :param name: name of the player creating the game
+        :param game_id: id for the game, a new one is made up if not given
         :return: returns the id of the game
         """
-        game_id = str(uuid.uuid4())
-        new_game = Game(max_players)
-        self.games[game_id] = new_game
+        if game_id is None:
+            game_id = self.ids.allocate()
+        new_game = Game(max_players, self.puzzles.next_puzzle())
+        # The creator joins before the game is listed, so it is never seen empty
+        new_game.add_player(player_id, name)
+        self.add_game(game_id, new_game)
         return game_id
 
+    def add_game(self, game_id, game):
+        """
+        Registers a game, lists it and hands it to the reaper
+        :param game_id: id of the game
+        :param game: the game, with its first players added
+        """
+        # Games carried over from a primary or a log keep their ids, new games must not reuse them
+        self.ids.reserve(game_id)
+        game.listener = partial(self.update_index, game_id, next(self.sequence))
+        game.journal = partial(self.log_event, game_id)
+        with game.lock:
+            if self.journal is not None:
+                self.journal(["game", game_id, game.snapshot()])
+            self.games[game_id] = game
+            game.lobby_changed()
+        self.reaper.schedule(game_id, self.expiry(game)[0])
+
+    def log_event(self, game_id, kind, version, *args):
+        """
+        Hands a change of a game to the journal. Called with the game's lock held.
+        """
+        if self.journal is not None:
+            self.journal([kind, game_id, version] + list(args))
+
+    def replay(self, event):
+        """
+        Applies a change journaled by another Games object. Changes the game has already seen are skipped, so
+        changes may be replayed on top of a snapshot that already holds some of them.
+        :param event: [kind, game_id, ...] as handed to the journal
+        """
+        kind, game_id = event[0], event[1]
+        if kind == "game":
+            if game_id not in self.games:
+                self.add_game(game_id, Game.from_snapshot(event[2]))
+            return
+        game = self.games.get(game_id)
+        if game is None:
+            return
+        if kind == "reap":
+            self.reap(game_id, float("inf"))
+            return
+
+        version, args = event[2], event[3:]
+        with game.lock:
+            if version <= game.version:
+                return
+            if kind == "join":
+                game.add_player(*args)
+            elif kind == "move":
+                game.make_move(*args)
+            elif kind == "leave":
+                game.remove_player(*args)
+
     def get_game(self, game_id):
         """
         Returns a game instance for a given game id.
         """
         return self.games[game_id]
 
-    def remove_empty(self):
+    def update_index(self, game_id, seq, game):
+        """
+        Lists or unlists a game in the lobby after its players or game state changed.
+        Finished and empty games are handed to the reaper. Called with the game's lock held.
+        :param game_id: id of the game
+        :param seq: sequence number of the game
+        :param game: the game that changed
+        """
+        with self.index_lock:
+            if game.scores and game.game_state != 2:
+                if seq in self.listed:
+                    self.record_lobby_change(_UPDATED, seq, game_id)
+                else:
+                    insort(self.listed_seqs, seq)
+                    self.listed[seq] = (game_id, game)
+                    self.record_lobby_change(_ADDED, seq, game_id)
+            elif self.listed.pop(seq, None) is not None:
+                del self.listed_seqs[bisect_right(self.listed_seqs, seq) - 1]
+                self.record_lobby_change(_REMOVED, seq, game_id)
+
+        if not game.scores or game.game_state == 2:
+            self.reaper.schedule(game_id, self.expiry(game)[0])
+
+    def expiry(self, game):
+        """
+        Returns when the game should be evicted and why
+        :param game: the game
+        :return: (time, reason)
+        """
+        if game.game_state == 2:
+            return game.finished_at + self.finished_ttl, "finished"
+        if not game.scores:
+            return game.last_activity + self.empty_ttl, "empty"
+        return game.last_activity + self.idle_ttl, "idle"
+
+    def reap(self, game_id, now):
         """
-        Removes an empty games from the dictionary of games
+        Evicts the game if its time to live has passed. Called by the reaper.
+        :param game_id: id of the game
+        :param now: current time
+        :return: when to check the game again, None if it is gone
         """
-        for game_id, game in self.games.items():
-            if len(game.scores) == 0:
-                del self.games[game_id]
+        game = self.games.get(game_id)
+        if game is None:
+            return None
+
+        with game.lock:
+            deadline, reason = self.expiry(game)
+            if deadline > now:
+                return deadline
+
+            game.removed = True
+            if game.game_state != 2:
+                # Let the players still waiting in an abandoned game know it is over
+                game.finish()
+                game.changed()
+                game.lobby_changed()
+            self.games.pop_if(game_id, game)
+            if self.journal is not None:
+                self.journal(["reap", game_id])
+
+        self.reaped[reason] += 1
+        self.bytes_freed += game.footprint()
+        return None
+
+    def record_lobby_change(self, kind, seq, game_id):
+        """
+        Bumps the lobby version and remembers the change. Called with the index lock held.
+        """
+        self.lobby_version += 1
+        if len(self.lobby_history) == self.lobby_history.maxlen:
+            # The oldest change is about to be dropped, older versions can only get the full lobby
+            self.lobby_floor = self.lobby_history[0][0]
+        self.lobby_history.append((self.lobby_version, kind, seq, game_id))
 
     def remove_player_from_game(self, game_id, player_id):
         """
@@ -46,17 +246,95 @@ class Games:
         Returns tuple representation of games,
         :return: (room_id, num_players, max_players)
         '''
-        output = []
-        self.remove_empty()
         # (room_id, num players, max players)
-        for uid, game in self.games.items():
-            if game.game_state != 2:
-                elem = tuple((uid, len(game.scores), game.max_players))
-                output.append(elem)
-        return output
+        with self.index_lock:
+            return [(uid, len(game.scores), game.max_players) for uid, game in
+                    (self.listed[seq] for seq in self.listed_seqs)]
+
+    def get_changes(self, version=None):
+        """
+        Returns how the lobby changed since the given lobby version
+        :param version: lobby version the caller has seen, None if it has not seen the lobby yet
+        :return: an unchanged answer, a diff of added, removed and updated rooms or the full lobby if the caller
+        is too far behind
+        """
+        with self.index_lock:
+            if version is not None:
+                version = int(version)
+            if version == self.lobby_version:
+                return [LOBBY_UNCHANGED, self.lobby_version]
+            if version is None or version < self.lobby_floor or version > self.lobby_version:
+                return [LOBBY_FULL, self.lobby_version, self.get_tuple()]
+
+            # First change after the caller's version for every game that changed
+            first_changes = {}
+            for change_version, kind, seq, game_id in reversed(self.lobby_history):
+                if change_version <= version:
+                    break
+                first_changes[seq] = (kind, game_id)
+
+            added, removed, updated = [], [], []
+            for seq in sorted(first_changes):
+                kind, game_id = first_changes[seq]
+                if seq in self.listed:
+                    uid, game = self.listed[seq]
+                    row = (uid, len(game.scores), game.max_players)
+                    (added if kind == _ADDED else updated).append(row)
+                elif kind != _ADDED:
+                    # Games listed and unlisted again since the caller's version were never seen by it
+                    removed.append(game_id)
+            return [LOBBY_DELTA, self.lobby_version, added, removed, updated]
+
+    def list_games(self, cursor=None, limit=MAX_PAGE, filters=None, version=None):
+        """
+        Returns one page of the lobby
+        :param cursor: cursor returned with the previous page, None for the first page
+        :param limit: maximum number of games on the page
+        :param filters: optional dict of filters, see matches
+        :param version: lobby version the caller has seen, if it is still current no rows are sent
+        :return: [list of (room_id, num_players, max_players), cursor of the next page or None if this was the
+        last, lobby version]. Rows and cursor are None if the lobby has not changed since the given version.
+        """
+        limit = min(max(int(limit), 1), MAX_PAGE)
+        output = []
+        with self.index_lock:
+            if version is not None and int(version) == self.lobby_version:
+                return [None, None, self.lobby_version]
+
+            seqs = self.listed_seqs
+            i = 0 if cursor is None else bisect_right(seqs, int(cursor))
+            while i < len(seqs) and len(output) < limit:
+                uid, game = self.listed[seqs[i]]
+                if not filters or matches(game, filters):
+                    output.append((uid, len(game.scores), game.max_players))
+                i += 1
+            next_cursor = seqs[i - 1] if i < len(seqs) else None
+            return [output, next_cursor, self.lobby_version]
+
+    def get_metrics(self):
+        """
+        Returns the number of games and what has been reclaimed by the reaper
+        """
+        return {
+            "games": len(self.games),
+            "listed": len(self.listed),
+            "scheduled": len(self.reaper),
+            "reaped": dict(self.reaped),
+            "bytes_freed": self.bytes_freed,
+        }
+
+    def get_load(self):
+        """
+        Returns the number of players in games, the number of free seats in the games on the lobby and the number
+        of games
+        """
+        players = sum(len(game.scores) for game in self.games.values())
+        with self.index_lock:
+            open_seats = sum(game.max_players - len(game.scores) for _, game in self.listed.values())
+        return players, open_seats, len(self.games)
 
     def get_nr_games(self):
         """
         Returns the number of games
         """
-        return len(self.games.keys())
+        return len(self.games)
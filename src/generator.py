@@ -0,0 +1,309 @@
+import logging
+import multiprocessing
+import random
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+LOG = logging.getLogger()
+
+ALL_DIGITS = 0x3FE  # Bits 1-9 set
+CLUES = 30  # Number of given digits left on a generated board
+RATE_WINDOW = 32  # Number of recent generations the throughput is measured over
+RETRY_DELAY = 0.5  # Seconds before a job is queued after a failed one, doubled with every failure in a row
+MAX_RETRY_DELAY = 30.0  # Longest pause between jobs while they keep failing
+
+# Index of the 3x3 box each of the 81 cells belongs to
+_BOXES = [(i // 27) * 3 + (i % 9) // 3 for i in range(81)]
+
+
+def _digits(mask):
+    """
+    Returns the digits whose bits are set in the mask.
+    """
+    return [d for d in range(1, 10) if mask & (1 << d)]
+
+
+def _count_solutions(cells, limit, rng=None):
+    """
+    Backtracking solver working on bitmasks of used digits per row, column and box.
+    Fills the cells list in place with the first solution found.
+    :param cells: 81 digits, 0 for an empty cell
+    :param limit: stop searching after this many solutions
+    :param rng: if given, candidates are tried in random order
+    :return: number of solutions found, at most limit
+    """
+    rows, cols, boxes = [0] * 9, [0] * 9, [0] * 9
+    empty = []
+    for i, digit in enumerate(cells):
+        if digit:
+            bit = 1 << digit
+            r, c, b = i // 9, i % 9, _BOXES[i]
+            if (rows[r] | cols[c] | boxes[b]) & bit:
+                return 0
+            rows[r] |= bit
+            cols[c] |= bit
+            boxes[b] |= bit
+        else:
+            empty.append(i)
+
+    solution = []
+    found = [0]
+
+    def search():
+        if not empty:
+            found[0] += 1
+            if not solution:
+                solution.extend(cells)
+            return
+
+        # Most constrained cell first
+        best, best_free, best_count = None, 0, 10
+        for pos, i in enumerate(empty):
+            free = ALL_DIGITS & ~(rows[i // 9] | cols[i % 9] | boxes[_BOXES[i]])
+            count = bin(free).count("1")
+            if count < best_count:
+                best, best_free, best_count = pos, free, count
+                if count <= 1:
+                    break
+        if best_count == 0:
+            return
+
+        i = empty[best]
+        empty[best] = empty[-1]
+        empty.pop()
+        r, c, b = i // 9, i % 9, _BOXES[i]
+
+        candidates = _digits(best_free)
+        if rng is not None:
+            rng.shuffle(candidates)
+        for digit in candidates:
+            bit = 1 << digit
+            rows[r] |= bit
+            cols[c] |= bit
+            boxes[b] |= bit
+            cells[i] = digit
+            search()
+            cells[i] = 0
+            rows[r] &= ~bit
+            cols[c] &= ~bit
+            boxes[b] &= ~bit
+            if found[0] >= limit:
+                break
+
+        empty.append(i)
+        empty[best], empty[-1] = empty[-1], empty[best]
+
+    search()
+    if solution:
+        cells[:] = solution
+    return found[0]
+
+
+def has_unique_solution(cells):
+    """
+    Checks that a board of 81 digits can be solved in exactly one way.
+    """
+    return _count_solutions(list(cells), 2) == 1
+
+
+def solve(cells):
+    """
+    Solves a board.
+    :param cells: 81 digits, 0 for an empty cell
+    :return: the 81 digits of a solution, None if the board cannot be solved
+    """
+    cells = list(cells)
+    return cells if _count_solutions(cells, 1) else None
+
+
+def generate_puzzle(seed=None, clues=CLUES):
+    """
+    Generates a random puzzle that has a unique solution.
+    :param seed: random seed, worker processes need distinct seeds
+    :param clues: number of digits left on the board, if uniqueness allows it
+    :return: solution, board as 9x9 lists
+    """
+    rng = random.Random(seed)
+
+    solution = [0] * 81
+    _count_solutions(solution, 1, rng)
+
+    board = list(solution)
+    positions = list(range(81))
+    rng.shuffle(positions)
+    given = 81
+    for i in positions:
+        if given <= clues:
+            break
+        digit = board[i]
+        board[i] = 0
+        if has_unique_solution(board):
+            given -= 1
+        else:
+            board[i] = digit
+
+    return [solution[i:i + 9] for i in range(0, 81, 9)], [board[i:i + 9] for i in range(0, 81, 9)]
+
+
+def _generate_job(seed, clues):
+    """
+    Runs generate_puzzle in a worker process. Errors are returned rather than raised, as process pools of
+    Python 2 take no error_callback and would drop the job without a word.
+    :return: (puzzle, None) or (None, the formatted traceback)
+    """
+    try:
+        return generate_puzzle(seed, clues), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _init_worker():
+    """
+    Lets the server handle keyboard interrupts instead of every worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PuzzlePool(object):
+    """
+    Bounded pool of freshly generated puzzles.
+    Generation runs in a pool of worker processes and is topped up in the background whenever
+    puzzles are taken out, so handing out a puzzle never waits for the generator.
+    """
+
+    def __init__(self, fallback, size=32, workers=2, clues=CLUES):
+        """
+        :param fallback: puzzle source used while the pool is empty
+        :param size: maximum number of ready puzzles kept around
+        :param workers: number of generator processes
+        :param clues: number of digits left on generated boards
+        """
+        self.fallback = fallback
+        self.size = int(size)
+        self.workers = int(workers)
+        self.clues = int(clues)
+
+        self.puzzles = deque()
+        self.lock = threading.Condition()
+        self.in_flight = 0
+        self.generated = 0
+        self.served = 0
+        self.misses = 0
+        self.failed = 0
+        # Failures since the last puzzle was generated, while there are any jobs are queued one at a time and
+        # not before retry_at
+        self.failing = 0
+        self.retry_at = 0
+        self.finished_at = deque(maxlen=RATE_WINDOW)
+
+        self.process_pool = None
+        self.refill_thread = None
+
+    def start(self):
+        """
+        Starts the worker processes and the background refill thread.
+        """
+        self.process_pool = multiprocessing.Pool(self.workers, _init_worker)
+        self.refill_thread = threading.Thread(target=self.__refill_loop)
+        self.refill_thread.setDaemon(True)
+        self.refill_thread.start()
+
+    def __refill_loop(self):
+        """
+        Keeps enough generation jobs queued to fill the pool up to its size.
+        """
+        rng = random.SystemRandom()
+        while True:
+            with self.lock:
+                while True:
+                    missing = self.size - len(self.puzzles) - self.in_flight
+                    if self.failing:
+                        # Find out with a single job at a time whether the generator works again
+                        missing = min(missing, 1 - self.in_flight)
+                    pause = self.retry_at - time.time()
+                    if missing > 0 and pause <= 0:
+                        break
+                    self.lock.wait(pause if missing > 0 else None)
+                self.in_flight += missing
+
+            callbacks = {"callback": self.__job_done}
+            if sys.version_info[0] >= 3:
+                # Jobs can also fail outside of _generate_job, for instance while their result is sent back
+                callbacks["error_callback"] = self.__job_failed
+            for _ in range(missing):
+                self.process_pool.apply_async(_generate_job, (rng.getrandbits(64), self.clues), **callbacks)
+
+    def __job_done(self, result):
+        """
+        Called by the process pool when a worker has finished a job.
+        """
+        puzzle, error = result
+        if error is not None:
+            self.__job_failed(error)
+            return
+        with self.lock:
+            self.puzzles.append(puzzle)
+            self.in_flight -= 1
+            self.generated += 1
+            if self.failing:
+                # The generator works again, the refill loop may queue as many jobs as are missing
+                self.failing = 0
+                self.lock.notify()
+            self.finished_at.append(time.time())
+
+    def __job_failed(self, error):
+        """
+        Called when a job failed, so the refill loop queues another one in its place once the retry delay has
+        passed.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.failed += 1
+            self.failing += 1
+            delay = min(RETRY_DELAY * 2 ** (self.failing - 1), MAX_RETRY_DELAY)
+            self.retry_at = time.time() + delay
+            self.lock.notify()
+        LOG.error("Puzzle generation failed, retrying in %.1fs: %s" % (delay, error))
+
+    def next_puzzle(self):
+        """
+        Returns a generated puzzle, or one from the fallback source if the pool has run dry.
+        :return: solution, board as 9x9 lists
+        """
+        with self.lock:
+            if self.puzzles:
+                self.served += 1
+                puzzle = self.puzzles.popleft()
+                self.lock.notify()
+                return puzzle
+            self.misses += 1
+
+        LOG.warning("Puzzle pool is empty, falling back to the puzzle bank")
+        return self.fallback.next_puzzle()
+
+    def get_metrics(self):
+        """
+        Returns the pool depth, worker count and generation throughput.
+        """
+        with self.lock:
+            rate = 0.0
+            if len(self.finished_at) > 1:
+                elapsed = self.finished_at[-1] - self.finished_at[0]
+                if elapsed > 0:
+                    rate = (len(self.finished_at) - 1) / elapsed
+            return {
+                "source": "generator",
+                "depth": len(self.puzzles),
+                "size": self.size,
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "generated": self.generated,
+                "served": self.served,
+                "misses": self.misses,
+                "failed": self.failed,
+                "puzzles_per_second": rate,
+            }
@@ -0,0 +1,467 @@
+import json
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import Pyro4
+
+from beacon import process_tree
+from board import decode_board, unpack_rows
+from game import STATE_FULL, STATE_DELTA
+from generator import solve
+
+__DESC = "Starts a server and plays on it with simulated clients, reports the latency of every call and the " \
+         "server's CPU and memory use as JSON"
+
+LOBBY_PAGE_SIZE = 50  # Same page size as the client
+SAMPLE_INTERVAL = 1.0  # Seconds between samples of the server's CPU and memory use
+STARTUP_TIMEOUT = 30  # Seconds the server may take to print its URI
+PERCENTILES = (50, 95, 99)
+GAME_FINISHED = 2
+LONG_POLL_TIMEOUT = 2  # Seconds a long-poll of a client waits for changes with --long-poll
+# Calls that wait for others by design, reported apart so they do not count towards the throughput
+BLOCKING = frozenset(["wait_for_change"])
+
+
+class Recorder(object):
+    """
+    Latencies and errors of the calls one bot makes, merged once the run is over.
+    Only calls started once the measurement has begun are recorded, those of the ramp up are left out.
+    """
+
+    def __init__(self, since):
+        """
+        :param since: time.time() from which on calls and counters are recorded
+        """
+        self.since = since
+        self.latencies = {}
+        self.errors = {}
+        self.counters = {"created": 0, "joined": 0, "full": 0, "finished": 0, "guesses": 0, "wrong": 0}
+
+    def call(self, proxy, method, *args):
+        """
+        Calls a method on the proxy and records how long it took
+        """
+        started = time.time()
+        measured = started >= self.since
+        try:
+            return getattr(proxy, method)(*args)
+        except Exception:
+            if measured:
+                self.errors[method] = self.errors.get(method, 0) + 1
+            raise
+        finally:
+            if measured:
+                self.latencies.setdefault(method, []).append(time.time() - started)
+
+    def count(self, name):
+        """
+        Adds one to a counter, if the measurement has begun
+        """
+        if time.time() >= self.since:
+            self.counters[name] += 1
+
+
+class Watcher(threading.Thread):
+    """
+    Long-polls for the changes of a game on a connection of its own and queues them, as the client's GameWatcher
+    """
+
+    def __init__(self, uri, token, version, since):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._stopevent = threading.Event()
+        self.uri = uri
+        self.token = token
+        self.version = version
+        self.updates = Queue()
+        self.recorder = Recorder(since)
+
+    def run(self):
+        proxy = Pyro4.Proxy(self.uri)
+        try:
+            while not self._stopevent.isSet():
+                state = self.recorder.call(proxy, "wait_for_change", self.token, self.version, LONG_POLL_TIMEOUT)
+                self.version = state[1]
+                self.updates.put(state)
+        except Exception as e:
+            if not self._stopevent.isSet():
+                sys.stderr.write("watcher: %s: %s\n" % (type(e).__name__, str(e)))
+        finally:
+            proxy._pyroRelease()
+
+    def stop(self):
+        self._stopevent.set()
+
+
+class Bot(threading.Thread):
+    """
+    Simulated player following the client's flow: log in, list the lobby, join a game with free seats or create
+    one, guess with a think time in between and poll for what the others did, quit the game once it is over and
+    go back to the lobby. Quits the server at the deadline.
+    With long_poll the changes are waited for on a second connection like the client does, otherwise they are
+    polled for after every guess.
+    """
+
+    def __init__(self, uri, name, since, deadline, think, error_rate, max_players, join_rate, seed,
+                 long_poll=False):
+        """
+        :param since: time.time() from which on the calls are recorded
+        :param deadline: time.time() at which to quit
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.uri = uri
+        self.name = name
+        self.deadline = deadline
+        self.think = think
+        self.error_rate = error_rate
+        self.max_players = max_players
+        self.join_rate = join_rate
+        self.rng = random.Random(seed)
+        self.long_poll = long_poll
+        self.recorder = Recorder(since)
+        self.watchers = []
+
+    def run(self):
+        # Pyro proxies belong to the thread that made them
+        proxy = Pyro4.Proxy(self.uri)
+        while time.time() < self.deadline:
+            try:
+                self.session(proxy)
+            except Exception as e:
+                # Start over with a new session, as a user would after a connection error
+                sys.stderr.write("%s: %s: %s\n" % (self.name, type(e).__name__, str(e)))
+                proxy._pyroRelease()
+                proxy = Pyro4.Proxy(self.uri)
+                time.sleep(self.think)
+        proxy._pyroRelease()
+
+    def session(self, proxy):
+        call = self.recorder.call
+        token = call(proxy, "login", self.name)
+        if token is None:
+            raise ValueError("Nickname %s is taken" % self.name)
+        try:
+            while time.time() < self.deadline:
+                state = self.enter_game(proxy, token)
+                if self.play(proxy, token, state):
+                    self.recorder.count("finished")
+                call(proxy, "quit_game", token)
+        finally:
+            call(proxy, "quit_server", token)
+
+    def enter_game(self, proxy, token):
+        """
+        Joins a game with free seats from the lobby or creates one, returns the game state
+        """
+        call = self.recorder.call
+        rooms, _, _ = call(proxy, "list_games", token, None, LOBBY_PAGE_SIZE, {"min_free": 1}, None)
+        if rooms and self.rng.random() < self.join_rate:
+            state = call(proxy, "join_game", token, self.rng.choice(rooms)[0])
+            if state:
+                self.recorder.count("joined")
+                return state
+            self.recorder.count("full")
+        self.recorder.count("created")
+        return call(proxy, "create_game", token, self.rng.randint(2, self.max_players))
+
+    def play(self, proxy, token, state):
+        """
+        Guesses until the game is over or the deadline has passed
+        :return: True if the game was played to the end
+        """
+        cells = sum(unpack_rows(decode_board(state[2])), [])
+        solution = solve(cells)
+        version, game_state = state[1], state[4]
+        watcher = None
+        if self.long_poll:
+            watcher = Watcher(self.uri, token, version, self.recorder.since)
+            watcher.start()
+            self.watchers.append(watcher)
+        try:
+            return self.guess(proxy, token, cells, solution, version, game_state, watcher)
+        finally:
+            if watcher is not None:
+                watcher.stop()
+
+    def guess(self, proxy, token, cells, solution, version, game_state, watcher):
+        """
+        Guesses until the game is over or the deadline has passed
+        :return: True if the game was played to the end
+        """
+        call = self.recorder.call
+        while game_state != GAME_FINISHED and time.time() < self.deadline:
+            time.sleep(self.rng.expovariate(1.0 / self.think) if self.think > 0 else 0)
+
+            empty = [i for i, digit in enumerate(cells) if digit == 0]
+            if not empty:
+                break
+            i = self.rng.choice(empty)
+            value = solution[i]
+            if self.rng.random() < self.error_rate:
+                value = self.rng.choice([digit for digit in range(1, 10) if digit != solution[i]])
+            results, state = call(proxy, "make_guesses", token, [(i // 9, i % 9, value)])
+            self.recorder.count("guesses")
+            if not results[0]:
+                self.recorder.count("wrong")
+            version, game_state = self.apply(cells, state, version, game_state)
+
+            # Catch up with the other players' moves
+            if watcher is None:
+                state = call(proxy, "get_state_since", token, version)
+                version, game_state = self.apply(cells, state, version, game_state)
+                continue
+            try:
+                while True:
+                    version, game_state = self.apply(cells, watcher.updates.get_nowait(), version, game_state)
+            except Empty:
+                pass
+        return game_state == GAME_FINISHED
+
+    @staticmethod
+    def apply(cells, state, version, game_state):
+        """
+        Applies a full or delta state to the bot's copy of the board
+        :return: version and game state after it
+        """
+        if state[1] < version:
+            return version, game_state
+        if state[0] == STATE_FULL:
+            cells[:] = sum(unpack_rows(decode_board(state[2])), [])
+        elif state[0] == STATE_DELTA:
+            for x, y, value in state[2]:
+                cells[x * 9 + y] = value
+        else:
+            return state[1], game_state
+        return state[1], state[4]
+
+
+def percentile(ordered, share):
+    """
+    Nearest-rank percentile of a sorted list
+    :param share: percentile, 0-100
+    """
+    rank = max(int(round(share / 100.0 * len(ordered))), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(recorders, seconds):
+    """
+    Merges the bots' recordings into throughput and latency percentiles in milliseconds per method.
+    The totals leave the BLOCKING calls out, their count is given apart.
+    """
+    methods = {}
+    counters = {}
+    for recorder in recorders:
+        for method, latencies in recorder.latencies.items():
+            methods.setdefault(method, []).extend(latencies)
+        for name, count in recorder.counters.items():
+            counters[name] = counters.get(name, 0) + count
+
+    report = {}
+    for method, latencies in sorted(methods.items()):
+        latencies.sort()
+        entry = {
+            "calls": len(latencies),
+            "errors": sum(recorder.errors.get(method, 0) for recorder in recorders),
+            "throughput": len(latencies) / seconds,
+            "mean_ms": 1000 * sum(latencies) / len(latencies),
+            "max_ms": 1000 * latencies[-1],
+            "blocking": method in BLOCKING,
+        }
+        for share in PERCENTILES:
+            entry["p%d_ms" % share] = 1000 * percentile(latencies, share)
+        report[method] = entry
+
+    total = sum(entry["calls"] for method, entry in report.items() if method not in BLOCKING)
+    blocking = sum(entry["calls"] for method, entry in report.items() if method in BLOCKING)
+    return report, {"calls": total, "throughput": total / seconds, "blocking_calls": blocking}, counters
+
+
+def read_usage(pid):
+    """
+    Reads the CPU time in seconds, the resident memory in KiB and the number of threads of a process and its
+    descendants from /proc
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu, rss, threads = 0.0, 0, 0
+    for member in process_tree(pid):
+        try:
+            with open("/proc/%d/stat" % member) as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            with open("/proc/%d/status" % member) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except (IOError, OSError):
+            continue
+        # utime and stime are the 14th and 15th fields, the first two are cut off with the command name
+        cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+    return cpu, rss, threads
+
+
+class UsageSampler(threading.Thread):
+    """
+    Samples the CPU and memory use and the threads of the server while the load runs
+    """
+
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._stopevent = threading.Event()
+        self.pid = pid
+        self.start_cpu, self.start_rss, self.threads = read_usage(pid)
+        self.cpu, self.rss = self.start_cpu, self.start_rss
+        self.peak_rss = self.start_rss
+        self.peak_threads = self.threads
+
+    def run(self):
+        while not self._stopevent.isSet():
+            self._stopevent.wait(SAMPLE_INTERVAL)
+            self.cpu, self.rss, self.threads = read_usage(self.pid)
+            self.peak_rss = max(self.peak_rss, self.rss)
+            self.peak_threads = max(self.peak_threads, self.threads)
+
+    def join(self, timeout=None):
+        self._stopevent.set()
+        threading.Thread.join(self, timeout)
+
+    def report(self, seconds):
+        used = self.cpu - self.start_cpu
+        return {
+            "pid": self.pid,
+            "cpu_seconds": used,
+            "cpu_percent": 100 * used / seconds,
+            "rss_start_kb": self.start_rss,
+            "rss_end_kb": self.rss,
+            "rss_peak_kb": self.peak_rss,
+            "threads_peak": self.peak_threads,
+        }
+
+
+def start_server(python, port, extra_args, threadpool):
+    """
+    Starts server.py next to this file and waits until it serves
+    :return: (process, URI)
+    """
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    command = [python, server, "-n", "loadgen", "-host", "127.0.0.1", "-p", str(port)] + extra_args
+    if threadpool is not None:
+        # Every connected client holds one of the server's Pyro worker threads
+        command += ["--threadpool", str(threadpool)]
+    process = subprocess.Popen(command, stderr=subprocess.PIPE, cwd=os.path.dirname(server))
+
+    found = []
+    ready = threading.Event()
+
+    def drain():
+        # Keeps reading the log, a full pipe would block the server
+        for line in iter(process.stderr.readline, b""):
+            match = re.search(r"URI is: (\S+)", line.decode("utf-8", "replace"))
+            if match and not found:
+                found.append(match.group(1))
+                ready.set()
+        ready.set()
+
+    reader = threading.Thread(target=drain)
+    reader.setDaemon(True)
+    reader.start()
+    ready.wait(STARTUP_TIMEOUT)
+    if not found:
+        process.kill()
+        raise RuntimeError("The server did not start: %s" % " ".join(command))
+    return process, found[0]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__DESC)
+    parser.add_argument("-c", "--clients", help="Number of simulated clients", type=int, default=20)
+    parser.add_argument("-s", "--seconds", help="How long to run the load", type=float, default=30)
+    parser.add_argument("-t", "--think", help="Mean seconds a client thinks before each guess", type=float,
+                        default=0.5)
+    parser.add_argument("-e", "--error-rate", help="Share of the guesses that are wrong", type=float, default=0.2)
+    parser.add_argument("-mp", "--max-players", help="Most players in the games the clients create", type=int,
+                        default=4)
+    parser.add_argument("-j", "--join-rate", help="Chance that a client joins a game with free seats instead of "
+                                                 "creating one", type=float, default=0.8)
+    parser.add_argument("-r", "--ramp", help="Seconds over which the clients are started", type=float, default=2)
+    parser.add_argument("-p", "--port", help="Port of the started server", type=int, default=7790)
+    parser.add_argument("--python", help="Interpreter to start the server with", default=sys.executable)
+    parser.add_argument("--server-args", help="Extra arguments for server.py, as one string", default="-g 0")
+    parser.add_argument("--threadpool", help="Pyro worker threads of the started server, each connected client "
+                                             "holds one", type=int)
+    parser.add_argument("-lp", "--long-poll", help="Wait for changes with wait_for_change on a second connection "
+                                                   "like the client, instead of polling after every guess",
+                        action="store_true")
+    parser.add_argument("--uri", help="Load an already running server instead of starting one")
+    parser.add_argument("--pid", help="Process id of the server given by --uri, for its CPU and memory use",
+                        type=int)
+    parser.add_argument("-o", "--output", help="File to write the JSON report to, standard output if not given")
+    args = parser.parse_args()
+
+    process = None
+    if args.uri:
+        uri, pid = args.uri, args.pid
+    else:
+        connections = args.clients * (2 if args.long_poll else 1)
+        threadpool = args.threadpool if args.threadpool is not None else connections + 8
+        process, uri = start_server(args.python, args.port, shlex.split(args.server_args), threadpool)
+        pid = process.pid
+    try:
+        # The measurement begins once all the clients have been started
+        since = time.time() + args.ramp
+        deadline = since + args.seconds
+        bots = [Bot(uri, "bot%d" % i, since, deadline, args.think, args.error_rate, args.max_players,
+                    args.join_rate, i, args.long_poll) for i in range(args.clients)]
+        for bot in bots:
+            bot.start()
+            time.sleep(args.ramp / max(len(bots), 1))
+
+        time.sleep(max(since - time.time(), 0))
+        sampler = UsageSampler(pid) if pid else None
+        if sampler:
+            sampler.start()
+        for bot in bots:
+            bot.join()
+        seconds = time.time() - since
+        watchers = [watcher for bot in bots for watcher in bot.watchers]
+        for watcher in watchers:
+            watcher.join()
+
+        if sampler:
+            sampler.join()
+        recorders = [bot.recorder for bot in bots] + [watcher.recorder for watcher in watchers]
+        methods, totals, counters = summarize(recorders, seconds)
+        report = {
+            "config": vars(args),
+            "seconds": seconds,
+            "methods": methods,
+            "totals": totals,
+            "games": counters,
+            "server": sampler.report(seconds) if sampler else None,
+        }
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
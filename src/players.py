@@ -1,19 +1,31 @@
-import uuid
+from registry import StripedDict, IdAllocator
 
 
 class Players:
 
     def __init__(self):
-        self.players = {}
+        self.players = StripedDict()
+        self.ids = IdAllocator()
 
-    def reg_player(self, name):
+    def reg_player(self, name, player_id=None):
         """
         Creates a new player and associates it's nickname to an id.
+        The id is made up unless one is given, as for players carried over from another server.
         """
-        player_id = str(uuid.uuid4())
+        if player_id is None:
+            player_id = self.ids.allocate()
+        else:
+            self.ids.reserve(player_id)
         self.players[player_id] = name
         return player_id
 
+    def reserve_id(self, player_id):
+        """
+        Makes sure the id of a player seen elsewhere, as in a game carried over from another server, is never
+        handed out to a new player.
+        """
+        self.ids.reserve(player_id)
+
     def remove_player(self, player_id):
         """
         Removes a player from the dictionary of players
@@ -0,0 +1,135 @@
+import mmap
+import random
+import struct
+import sys
+
+# Binary bank layout: magic, record count, then one record per puzzle.
+# A record holds the 81 solution digits followed by the 81 starting board digits, one byte each.
+BANK_MAGIC = b"SDKB"
+BANK_HEADER = struct.Struct("<4sI")
+CELLS = 81
+RECORD_SIZE = CELLS * 2
+
+
+class PuzzleBankError(Exception):
+    """
+    Raised when a puzzle file cannot be parsed.
+    """
+    pass
+
+
+def parse_puzzles(lines):
+    """
+    Parses puzzles from the text format of solutions.txt.
+    Every puzzle is a 9 line solution followed by a 9 line starting board, blocks are separated by blank lines.
+    :param lines: iterable of text lines
+    :return: bytearray with one record per puzzle
+    """
+    digits = []
+    for line in lines:
+        row = line.split()
+        if not row:
+            continue
+        if len(row) != 9:
+            raise PuzzleBankError("There must be 9 columns to a row")
+        digits.extend(int(digit) for digit in row)
+
+    if len(digits) % RECORD_SIZE != 0:
+        raise PuzzleBankError("Every puzzle needs 9 solution rows and 9 board rows")
+    if any(digit < 0 or digit > 9 for digit in digits):
+        raise PuzzleBankError("Only numbers between 0-9 are permitted on the sudoku field")
+
+    return bytearray(digits)
+
+
+def _to_rows(cells):
+    """
+    Turns 81 flat cell values into a 9x9 list of lists.
+    """
+    return [list(cells[i:i + 9]) for i in range(0, CELLS, 9)]
+
+
+class PuzzleBank(object):
+    """
+    Pre-parsed, in-memory collection of puzzles.
+    The bank is loaded once at server start, after which picking a puzzle does no file I/O.
+    """
+
+    def __init__(self, records, offset=0):
+        """
+        :param records: buffer (bytearray or mmap) holding the fixed size puzzle records
+        :param offset: position of the first record in the buffer
+        """
+        size = len(records) - offset
+        if size <= 0 or size % RECORD_SIZE != 0:
+            raise PuzzleBankError("The puzzle bank is empty or truncated")
+        self.records = records
+        self.offset = offset
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a puzzle bank from either a binary bank file (memory-mapped) or a text puzzle file.
+        :param path: path of the file
+        :return: PuzzleBank
+        """
+        with open(path, "rb") as f:
+            if f.read(len(BANK_MAGIC)) == BANK_MAGIC:
+                return cls._map_binary(f)
+
+        with open(path, "r") as f:
+            return cls(parse_puzzles(f))
+
+    @classmethod
+    def _map_binary(cls, f):
+        """
+        Memory-maps an open binary bank file.
+        """
+        records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, count = BANK_HEADER.unpack_from(records, 0)
+        if len(records) != BANK_HEADER.size + count * RECORD_SIZE:
+            records.close()
+            raise PuzzleBankError("The puzzle bank is empty or truncated")
+        return cls(records, BANK_HEADER.size)
+
+    def save(self, path):
+        """
+        Writes the bank out in the binary format, so later loads can memory-map it.
+        :param path: path of the file
+        """
+        with open(path, "wb") as f:
+            f.write(BANK_HEADER.pack(BANK_MAGIC, len(self)))
+            f.write(bytes(bytearray(self.records[self.offset:])))
+
+    def __len__(self):
+        return (len(self.records) - self.offset) // RECORD_SIZE
+
+    def get(self, index):
+        """
+        Returns the puzzle at the given index.
+        :param index: puzzle number
+        :return: solution, board as 9x9 lists
+        """
+        start = self.offset + index * RECORD_SIZE
+        record = bytearray(self.records[start:start + RECORD_SIZE])
+        return _to_rows(record[:CELLS]), _to_rows(record[CELLS:])
+
+    def next_puzzle(self):
+        """
+        Returns a randomly selected puzzle.
+        :return: solution, board as 9x9 lists
+        """
+        return self.get(random.randrange(len(self)))
+
+    def get_metrics(self):
+        """
+        Returns the size of the bank.
+        """
+        return {"source": "bank", "size": len(self)}
+
+
+if __name__ == "__main__":
+    # Converts a text puzzle file into a binary bank: puzzles.py solutions.txt solutions.bank
+    bank = PuzzleBank.load(sys.argv[1])
+    bank.save(sys.argv[2])
+    print("Wrote %d puzzles to %s" % (len(bank), sys.argv[2]))
@@ -0,0 +1,57 @@
+import heapq
+import logging
+import threading
+import time
+
+LOG = logging.getLogger()
+
+
+class Reaper(threading.Thread):
+    """
+    Background eviction scheduler keeping a heap of deadlines.
+    When a deadline passes, the reap callback decides whether the entry is reclaimed or gets a later deadline,
+    so entries only have to be scheduled again when their deadline moves earlier.
+    """
+
+    def __init__(self, reap):
+        """
+        :param reap: callback taking (key, now), returning a new deadline for the key or None once it is gone
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.reap = reap
+        self.deadlines = []
+        self.lock = threading.Condition()
+
+    def schedule(self, key, deadline):
+        """
+        Asks for the key to be checked at the given time. A key may be scheduled more than once.
+        :param key: key handed to the reap callback
+        :param deadline: time.time() at which to check the key
+        """
+        with self.lock:
+            heapq.heappush(self.deadlines, (deadline, key))
+            if self.deadlines[0][1] == key:
+                self.lock.notify()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.deadlines or self.deadlines[0][0] > time.time():
+                    if self.deadlines:
+                        self.lock.wait(self.deadlines[0][0] - time.time())
+                    else:
+                        self.lock.wait()
+                _, key = heapq.heappop(self.deadlines)
+
+            try:
+                deadline = self.reap(key, time.time())
+            except Exception as e:
+                LOG.error("Cannot reap %s: %s" % (key, str(e)))
+                continue
+
+            if deadline is not None:
+                self.schedule(key, deadline)
@@ -0,0 +1,159 @@
+import re
+import threading
+
+STRIPES = 16
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+# Only what encode_id writes: int() would also take signs, spaces, underscores and upper case
+_ID = re.compile(r"[0-9a-z]+\Z")
+
+
+def encode_id(number):
+    """
+    Writes a positive number in base 36
+    """
+    digits = []
+    while number:
+        number, digit = divmod(number, len(_DIGITS))
+        digits.append(_DIGITS[digit])
+    return "".join(reversed(digits)) or "0"
+
+
+def decode_id(text):
+    """
+    Reads a number written by encode_id
+    :raise ValueError: if the text is not a base 36 number in lower case
+    """
+    if not isinstance(text, (str, type(u""))) or not _ID.match(text):
+        raise ValueError("Not an id: %r" % (text,))
+    return int(text, len(_DIGITS))
+
+
+class IdAllocator(object):
+    """
+    Hands out short ids, the numbers counting up from 1 written in base 36.
+    They only name things, whoever has to prove who they are gets a token of its own.
+    """
+
+    def __init__(self):
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        """
+        Returns an id that has not been handed out or reserved before
+        """
+        with self.lock:
+            self.last += 1
+            return encode_id(self.last)
+
+    def reserve(self, id_):
+        """
+        Makes sure an id taken over from elsewhere, as from a primary or a log, is never handed out again.
+        Ids not written by encode_id, as the uuids of older logs, cannot clash and are ignored.
+        """
+        try:
+            number = decode_id(id_)
+        except ValueError:
+            return
+        with self.lock:
+            self.last = max(self.last, number)
+
+
+class StripedDict(object):
+    """
+    Dictionary split into stripes that each have a lock of their own.
+    Threads working on keys in different stripes never wait for each other.
+    """
+
+    def __init__(self, stripes=STRIPES):
+        """
+        :param stripes: number of independently locked stripes
+        """
+        self.stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def __stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def __getitem__(self, key):
+        items, lock = self.__stripe(key)
+        with lock:
+            return items[key]
+
+    def __setitem__(self, key, value):
+        items, lock = self.__stripe(key)
+        with lock:
+            items[key] = value
+
+    def __delitem__(self, key):
+        items, lock = self.__stripe(key)
+        with lock:
+            del items[key]
+
+    def __contains__(self, key):
+        items, lock = self.__stripe(key)
+        with lock:
+            return key in items
+
+    def __len__(self):
+        return sum(len(items) for items, _ in self.stripes)
+
+    def get(self, key, default=None):
+        items, lock = self.__stripe(key)
+        with lock:
+            return items.get(key, default)
+
+    def pop(self, key, default=None):
+        items, lock = self.__stripe(key)
+        with lock:
+            return items.pop(key, default)
+
+    def setdefault(self, key, value):
+        """
+        Inserts the value if the key is not taken yet
+        :return: the value stored under the key afterwards
+        """
+        items, lock = self.__stripe(key)
+        with lock:
+            return items.setdefault(key, value)
+
+    def pop_if(self, key, value):
+        """
+        Removes the key only if it still maps to the given value
+        :return: True if the key was removed
+        """
+        items, lock = self.__stripe(key)
+        with lock:
+            if items.get(key) is value:
+                del items[key]
+                return True
+            return False
+
+    def items(self):
+        """
+        Returns a snapshot of all the (key, value) pairs, safe to iterate while others modify the dictionary
+        """
+        snapshot = []
+        for items, lock in self.stripes:
+            with lock:
+                snapshot.extend(items.items())
+        return snapshot
+
+    def values(self):
+        """
+        Returns a snapshot of all the values
+        """
+        snapshot = []
+        for items, lock in self.stripes:
+            with lock:
+                snapshot.extend(items.values())
+        return snapshot
+
+    def keys(self):
+        """
+        Returns a snapshot of all the keys
+        """
+        snapshot = []
+        for items, lock in self.stripes:
+            with lock:
+                snapshot.extend(items.keys())
+        return snapshot
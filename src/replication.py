@@ -0,0 +1,165 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+LOG = logging.getLogger()
+
+HEARTBEAT = 1.0  # Seconds between the pings the primary sends to its backups
+FAILURE_TIMEOUT = 3.0  # Seconds without a line from the primary after which a backup considers it failed
+BACKLOG_SIZE = 100000  # Events queued for a backup before it is dropped as too slow
+_PING = json.dumps(["ping"]) + "\n"
+_STOP = None  # Queued for a backup that has been dropped
+
+
+def parse_address(text):
+    """
+    Parses a host:port address
+    :return: (host, port)
+    """
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+
+class Replicator(threading.Thread):
+    """
+    Streams the ordered log of changes to backups, one JSON list per line.
+    Every backup first gets a snapshot of the current state as events, then every change published after it
+    connected. Events a backup sees in both are skipped on its side by their version.
+    """
+
+    def __init__(self, snapshot, host, port):
+        """
+        :param snapshot: callable returning the current state as a list of events
+        :param host: address to listen on for backups
+        :param port: port to listen on for backups
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.snapshot = snapshot
+        self.address = (host, port)
+        self.backlogs = set()
+        self.lock = threading.Lock()
+
+    def publish(self, event):
+        """
+        Queues an event for every backup, never blocks
+        :param event: JSON serializable list starting with the kind of the event
+        """
+        self.__queue(json.dumps(event) + "\n")
+
+    def __queue(self, line):
+        with self.lock:
+            for backlog in list(self.backlogs):
+                try:
+                    backlog.put_nowait(line)
+                except Full:
+                    LOG.error("Dropping a backup that has fallen too far behind")
+                    self.backlogs.discard(backlog)
+                    with backlog.mutex:
+                        backlog.queue.clear()
+                    backlog.put_nowait(_STOP)
+
+    def __heartbeat(self):
+        """
+        Pings the backups, so they can tell a quiet primary from a failed one
+        """
+        while True:
+            time.sleep(HEARTBEAT)
+            self.__queue(_PING)
+
+    def run(self):
+        heartbeat = threading.Thread(target=self.__heartbeat)
+        heartbeat.setDaemon(True)
+        heartbeat.start()
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(8)
+        LOG.info("Replicating to backups connecting to %s:%d" % self.address)
+        while True:
+            conn, address = listener.accept()
+            LOG.info("Backup connected from %s:%d" % address)
+            sender = threading.Thread(target=self.serve, args=(conn,))
+            sender.setDaemon(True)
+            sender.start()
+
+    def serve(self, conn):
+        """
+        Sends the snapshot and then the published events to one backup until it goes away or is dropped
+        """
+        backlog = Queue(BACKLOG_SIZE)
+        with self.lock:
+            self.backlogs.add(backlog)
+        try:
+            conn.sendall("".join(json.dumps(event) + "\n" for event in self.snapshot()).encode("utf-8"))
+            # A blocking get, waiting with a timeout polls on Python 2 and would delay every event
+            line = backlog.get()
+            while line is not _STOP:
+                conn.sendall(line.encode("utf-8"))
+                line = backlog.get()
+        except socket.error as e:
+            LOG.info("Backup went away: %s" % str(e))
+        finally:
+            with self.lock:
+                self.backlogs.discard(backlog)
+            conn.close()
+
+
+def follow(address, start):
+    """
+    Applies the events of a primary until it fails
+    :param address: (host, port) the primary replicates to
+    :param start: called once the primary has started sending, resets the local state and returns the callback
+    applying an event
+    :return: False if the primary could not be reached or went away before sending anything
+    """
+    try:
+        conn = socket.create_connection(address, FAILURE_TIMEOUT)
+    except socket.error:
+        return False
+
+    # The local state is only thrown away once the primary has proven alive by sending its snapshot or a ping
+    apply_event = None
+    reader = conn.makefile("rb")
+    try:
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            if apply_event is None:
+                LOG.info("Following %s:%d" % address)
+                apply_event = start()
+            event = json.loads(line.decode("utf-8"))
+            if event[0] != "ping":
+                apply_event(event)
+    except (socket.error, ValueError) as e:
+        LOG.debug("Error from %s:%d: %s" % (address[0], address[1], str(e)))
+    finally:
+        reader.close()
+        conn.close()
+    if apply_event is not None:
+        LOG.info("Lost %s:%d" % address)
+    return apply_event is not None
+
+
+def wait_for_takeover(chain, start):
+    """
+    Follows the first reachable server ahead of this one, until none of them can be reached any more.
+    Returns with the state of the last server followed, at which point this server should take over.
+    :param chain: (host, port) replication addresses of the servers ahead of this one, in the order they take over
+    :param start: see follow
+    """
+    while True:
+        for address in chain:
+            if follow(address, start):
+                break
+        else:
+            return
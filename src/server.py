@@ -1,13 +1,22 @@
+import binascii
+import functools
 import logging
+import os
 import Pyro4
-import threading
+import time
 from argparse import ArgumentParser
-from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_IP, IP_MULTICAST_LOOP, IP_MULTICAST_TTL
-from time import sleep
 
 # ---------- Logging ----------
-from games import Games
+from beacon import Announcer, LatencyMeter
+from games import Games, MAX_PAGE, FINISHED_TTL, EMPTY_TTL, IDLE_TTL
+from generator import PuzzlePool
 from players import Players
+from puzzles import PuzzleBank
+from reaper import Reaper
+from registry import StripedDict
+from replication import Replicator, parse_address, wait_for_takeover
+from shards import ShardedGames
+from wal import WriteAheadLog, FSYNC_INTERVAL, BATCH, SNAPSHOT_INTERVAL, next_sequence, recover
 
 FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
 logging.basicConfig(level=logging.DEBUG, format=FORMAT)
@@ -18,9 +27,24 @@ LOG = logging.getLogger()
 __NAME = "CompetitiveSudoku"
 __VER = "0.0.2"
 __DESC = "Simple Competitive Sudoku Game"
-
-_GAMES = Games()
+_MAX_WAIT = 30  # Longest a client may block in wait_for_change, in seconds
+_LEASE = 60  # Seconds a session stays alive without any RPC from its client
+_MAX_BATCH = 81  # Most guesses accepted in one make_guesses call
+# Pyro worker threads. Every connection holds one, and a client in a game keeps two: one for its calls and one
+# long-polling in wait_for_change. Pyro's default of 40 would turn away the 21st player.
+_THREADPOOL = 256
+__PUZZLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "solutions.txt")
+
+# Games are created once the puzzle bank has been loaded at startup
+_GAMES = None
 _PLAYERS = Players()
+# Streams every change to the backups, if any
+_REPLICATOR = None
+# Logs every change to disk, if enabled
+_WAL = None
+# Recent latency of the calls, reported in the multicast beacons. Calls that block by design are left out.
+_LATENCY = LatencyMeter()
+_BLOCKING = frozenset(["wait_for_change"])
 
 
 def __info():
@@ -34,6 +58,55 @@ def dummy_state():
             [('rth', 0, '6fbea54a-dcf3-4949-bd61-668440fafabf')], 0]
 
 
+def publish(event):
+    """
+    Hands a change to the write-ahead log and the backups, if there are any.
+    The log goes first, a change it refuses is not streamed either.
+    """
+    if _WAL is not None:
+        _WAL.append(event)
+    if _REPLICATOR is not None:
+        _REPLICATOR.publish(event)
+
+
+def check_journal():
+    """
+    Refuses changes once the write-ahead log has failed. Changes are checked before they are made, as a change
+    the log refuses afterwards would stay live in memory without ever being recovered.
+    :raise IOError: if the log has failed
+    """
+    if _WAL is not None:
+        _WAL.check()
+
+
+def changes_state(method):
+    """
+    Refuses the wrapped RPC once the write-ahead log has failed, see check_journal
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        check_journal()
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def renews_lease(method):
+    """
+    Renews the user's session lease whenever the wrapped RPC is called, and measures how long the call takes
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._renew_lease()
+        if method.__name__ in _BLOCKING:
+            return method(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _LATENCY.record(time.time() - started)
+    return wrapper
+
+
 @Pyro4.expose
 class User(object):
     """
@@ -41,142 +114,472 @@ class User(object):
     """
     global _GAMES, _PLAYERS
 
-    def __init__(self, name, competitive_sudoku):
+    # Users are kept per session, so keep them small. Pyro sets the last two when the user is registered.
+    __slots__ = ("name", "sudoku", "game", "id", "lease_expiry", "token", "_pyroId", "_pyroDaemon")
+
+    def __init__(self, name, competitive_sudoku, player_id=None):
         self.name = name
         self.sudoku = competitive_sudoku
         self.game = None
-        self.id = str(_PLAYERS.reg_player(name))
+        self.id = str(_PLAYERS.reg_player(name, player_id))
+        self.lease_expiry = time.time() + _LEASE
+        self.token = None
 
-    def get_games_list(self):
+    def _renew_lease(self):
         """
-        Get list of games on the server """
-        return _GAMES.get_tuple()
+        Keeps the session alive for another lease period """
+        self.lease_expiry = time.time() + _LEASE
 
+    @renews_lease
+    def get_games_list(self, version=None):
+        """
+        Get list of games on the server, or only what changed since the given lobby version """
+        return _GAMES.get_changes(version)
+
+    @renews_lease
+    def list_games(self, cursor=None, limit=MAX_PAGE, filters=None, version=None):
+        """
+        Get one page of the games on the server, filtered by free seats, max players or fill level.
+        Nothing is sent if the lobby is still at the given version """
+        return _GAMES.list_games(cursor, limit, filters, version)
+
+    @renews_lease
+    @changes_state
     def create_game(self, max_players):
         """
         Create a new sudoku game and return the state """
-        game_id = _GAMES.create_game(max_players)
-        game = _GAMES.get_game(game_id)
-        game.add_player(self.id)
-        self.game = game
-        return self.game.get_state(_PLAYERS)
+        game_id = _GAMES.create_game(max_players, self.id, self.name)
+        self.game = _GAMES.get_game(game_id)
+        return self.game.get_state()
 
+    @renews_lease
+    @changes_state
     def join_game(self, game_id):
         """
-        Join an existing sudoku game, returns the state """
+        Join an existing sudoku game, returns the state or None if the game is full """
         game = _GAMES.get_game(game_id)
-        game.add_player(self.id)
+        if not game.add_player(self.id, self.name):
+            return None
         self.game = game
-        return self.game.get_state(_PLAYERS)
+        return self.game.get_state()
 
+    @renews_lease
+    @changes_state
     def make_guess(self, x_coord, y_coord, val):
         """
         Make a guess on the sudoku table """
         self.game.make_move(self.id, int(x_coord), int(y_coord), int(val))
 
-        return self.game.get_state(_PLAYERS)
+        return self.game.get_state()
+
+    @renews_lease
+    @changes_state
+    def make_guesses(self, guesses):
+        """
+        Make a batch of guesses at once, returns whether each guess was correct and the state after the batch """
+        if len(guesses) > _MAX_BATCH:
+            raise ValueError("At most %d guesses can be made at once" % _MAX_BATCH)
+        moves = [(int(x_coord), int(y_coord), int(val)) for x_coord, y_coord, val in guesses]
+
+        return self.game.make_moves(self.id, moves)
 
+    @renews_lease
     def get_game_state(self):
         """
         Get the current playing field """
 
-        return self.game.get_state(_PLAYERS)
+        return self.game.get_state()
+
+    @renews_lease
+    def get_state_since(self, version):
+        """
+        Get only what changed in the game since the given version """
+
+        return self.game.get_state_since(int(version))
 
+    @renews_lease
+    def wait_for_change(self, version, timeout):
+        """
+        Wait until the game changes from the given version or the timeout expires,
+        then return what changed like get_state_since """
+
+        timeout = min(max(float(timeout), 0), _MAX_WAIT)
+        return self.game.wait_for_change(int(version), timeout)
+
+    @renews_lease
+    @changes_state
     def quit_game(self):
         """
         Quit the current sudoku game the user is taking part in """
         self.game.remove_player(self.id)
         self.game = None
 
+    @renews_lease
+    @changes_state
     def quit_server(self):
         """
         Quit the server completely """
-        self.sudoku.remove_player(self.name)
-        _PLAYERS.remove_player(self.id)
+        self.sudoku._end_session(self)
 
 
 @Pyro4.expose
 class CompetitiveSudoku(object):
     """
-    Main server class, complete functions and necessity to be determined
+    Main server class, complete functions and necessity to be determined.
+
+    Users can either register and get a Pyro object of their own, or log in and pass the session token
+    to the methods of this object. The latter keeps the daemon's object table from growing with the users
+    and lets many clients share connections.
     """
 
     def __init__(self):
-        self.users = {}
+        self.users = StripedDict()
+        self.sessions = StripedDict()
+        # Sessions whose lease has run out are expired in the background. They are keyed by (name, player id),
+        # as the name of an ended session can be taken by a new one while the old entry is still scheduled.
+        self.sessions_reaper = Reaper(self._expire_session)
 
     def register(self, name):
+        """
+        Start a session with a Pyro object of its own, returns its URI or None if the name is taken.
+        Only available while the games are neither logged nor replicated, as the object cannot be carried over """
+        if _WAL is not None or _REPLICATOR is not None:
+            raise ValueError("This server keeps its games across restarts, log in instead of registering")
+        user = self._new_user(name)
+        if user is None:
+            return None
+
+        user_uri = daemon.register(user)
+        return str(user_uri)
+
+    @changes_state
+    def login(self, name):
+        """
+        Start a session without a Pyro object of its own, returns the session token or None if the name is taken """
+        user = self._new_user(name)
+        if user is None:
+            return None
+
+        user.token = binascii.hexlify(os.urandom(8)).decode("ascii")
+        self.sessions[user.token] = user
+        publish(["login", name, user.id, user.token])
+        return user.token
+
+    def _new_user(self, name):
+        """
+        Reserves the nickname for a new user """
         if name in self.users:
             return None
 
         user = User(name, self)
-        self.users[name] = user
-        user_uri = daemon.register(user)
+        if self.users.setdefault(name, user) is not user:
+            # Someone else took the nickname in the meantime
+            _PLAYERS.remove_player(user.id)
+            return None
+        self.sessions_reaper.schedule((name, user.id), user.lease_expiry)
+        return user
 
-        return str(user_uri)
+    def _session(self, token):
+        """
+        Returns the user of the session token """
+        user = self.sessions.get(token)
+        if user is None:
+            raise ValueError("Unknown or expired session")
+        return user
+
+    def _end_session(self, user):
+        """
+        Frees the user's seat and name and forgets the session """
+        if not self.users.pop_if(user.name, user):
+            return
+        if user.game is not None:
+            user.game.remove_player(user.id)
+            user.game = None
+        _PLAYERS.remove_player(user.id)
+        if user.token is not None:
+            self.sessions.pop(user.token)
+            publish(["logout", user.name])
+        else:
+            daemon.unregister(user)
+
+    def _expire_session(self, key, now):
+        """
+        Ends the session of the user if its lease has run out
+        :param key: (name, player id) of the user """
+        name, player_id = key
+        user = self.users.get(name)
+        if user is None or user.id != player_id:
+            return None  # Ended already, the name may be someone else's by now
+        if user.lease_expiry > now:
+            return user.lease_expiry
+        LOG.info("Session of %s has expired" % name)
+        self._end_session(user)
+        return None
+
+    def _snapshot(self):
+        """
+        Returns the games and sessions as events, for a backup that has just connected """
+        events = [["game", game_id, game.snapshot()] for game_id, game in _GAMES.games.items()]
+        events.extend(["login", user.name, user.id, user.token] for user in self.sessions.values())
+        return events
 
-    def remove_player(self, name):
-        self.users.pop(name, None)
+    def _replay(self, event):
+        """
+        Applies a change streamed from the primary or read back from the write-ahead log """
+        if event[0] == "login":
+            name, player_id, token = event[1:]
+            if name in self.users:
+                return  # Already in the snapshot
+            user = User(name, self, player_id)
+            user.token = token
+            self.users[name] = user
+            self.sessions[token] = user
+            publish(event)
+        elif event[0] == "logout":
+            user = self.users.get(event[1])
+            if user is not None:
+                self._end_session(user)
+        else:
+            _GAMES.replay(event)
+            # Seats can outlive the sessions that took them, their ids must not go to new players
+            if event[0] == "game":
+                for entry in event[2]["leaderboard"]:
+                    _PLAYERS.reserve_id(entry[2])
+            elif event[0] == "join":
+                _PLAYERS.reserve_id(event[3])
+
+    def _take_over(self):
+        """
+        Picks up the sessions carried over from the primary or the write-ahead log: their games are looked up and
+        their leases start anew, so clients have a full lease to reconnect """
+        seats = {}
+        for game_id, game in _GAMES.games.items():
+            for player_id in game.scores:
+                seats[player_id] = game
+        for user in self.users.values():
+            user.game = seats.get(user.id)
+            user._renew_lease()
+            self.sessions_reaper.schedule((user.name, user.id), user.lease_expiry)
+
+    def get_games_list(self, token, version=None):
+        """
+        Same as User.get_games_list, for the user of the session token """
+        return self._session(token).get_games_list(version)
 
+    def list_games(self, token, cursor=None, limit=MAX_PAGE, filters=None, version=None):
+        """
+        Same as User.list_games, for the user of the session token """
+        return self._session(token).list_games(cursor, limit, filters, version)
 
-def send_sudoku_uri_multicast(sudoku_uri, mc_addr, server_name, ttl=1):
-    """
-    Main method to send sudoku URI to the local multicast group
-    :param sudoku_uri: Pyro URI to send out using multicast
-    :param mc_addr: Multicast group address as tuple (mc_host, mc_port)
-    :param ttl: Time to live
-    """
-    global _GAMES
+    def create_game(self, token, max_players):
+        """
+        Same as User.create_game, for the user of the session token """
+        return self._session(token).create_game(max_players)
 
-    multicast_payload = "SERVERADDR;" + str(sudoku_uri) + ";" + \
-                        str(server_name) + ";" + str(_GAMES.get_nr_games()) + ";"
+    def join_game(self, token, game_id):
+        """
+        Same as User.join_game, for the user of the session token """
+        return self._session(token).join_game(game_id)
+
+    def make_guess(self, token, x_coord, y_coord, val):
+        """
+        Same as User.make_guess, for the user of the session token """
+        return self._session(token).make_guess(x_coord, y_coord, val)
+
+    def make_guesses(self, token, guesses):
+        """
+        Same as User.make_guesses, for the user of the session token """
+        return self._session(token).make_guesses(guesses)
 
-    try:
-        s = socket(AF_INET, SOCK_DGRAM)
-        s.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, 1)  # Enable loop-back multicast
+    def get_game_state(self, token):
+        """
+        Same as User.get_game_state, for the user of the session token """
+        return self._session(token).get_game_state()
+
+    def get_state_since(self, token, version):
+        """
+        Same as User.get_state_since, for the user of the session token """
+        return self._session(token).get_state_since(version)
+
+    def wait_for_change(self, token, version, timeout):
+        """
+        Same as User.wait_for_change, for the user of the session token """
+        return self._session(token).wait_for_change(version, timeout)
 
-        if s.getsockopt(IPPROTO_IP, IP_MULTICAST_TTL) != ttl:
-            s.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, ttl)
+    def quit_game(self, token):
+        """
+        Same as User.quit_game, for the user of the session token """
+        return self._session(token).quit_game()
 
-        s.sendto(multicast_payload, mc_addr)
-        s.close()
+    def quit_server(self, token):
+        """
+        Same as User.quit_server, for the user of the session token """
+        return self._session(token).quit_server()
 
-    except Exception as e:
-        LOG.error("Cannot send multicast request: %s" % str(e))
+    def get_lobby_changes(self, version=None):
+        """
+        Returns how the lobby changed since the given lobby version, see Games.get_changes.
+        Needs no session, so directories can aggregate the lobbies of many servers """
+        return _GAMES.get_changes(version)
 
+    def ping(self):
+        """
+        Does nothing, lets clients measure the round trip time to the server """
+        return True
 
-def sudoku_uri_multicast(sudoku_uri, mc_addr, server_name):
-    while 1:
-        send_sudoku_uri_multicast(sudoku_uri, mc_addr, server_name)
-        sleep(1)
+    def get_metrics(self):
+        """
+        Returns server metrics for monitoring """
+        if isinstance(_GAMES, ShardedGames):
+            return {"shards": _GAMES.get_metrics()}
+        metrics = {"puzzles": _GAMES.puzzles.get_metrics(), "games": _GAMES.get_metrics()}
+        if _WAL is not None:
+            metrics["wal"] = _WAL.get_metrics()
+        return metrics
 
 
 if __name__ == "__main__":
-    parser = ArgumentParser(description=__info(), version=__VER)
+    parser = ArgumentParser(description=__info())
+    parser.add_argument("--version", action="version", version=__VER)
 
     parser.add_argument("-mc", "--multicast", help="Multicast group URI", default="239.1.1.1")
-    parser.add_argument("-mcp", "--mcport", help="Multicast group port", default=7778)
+    parser.add_argument("-mcp", "--mcport", help="Multicast group port", type=int, default=7778)
     parser.add_argument("-host", "--host", help="Pyro host URI", default="127.0.0.1")
-    parser.add_argument("-p", "--port", help="Pyro host port", default=7777)
+    parser.add_argument("-p", "--port", help="Pyro host port", type=int, default=7777)
     parser.add_argument("-n", "--name", help="Name of the game server", required=True)
+    parser.add_argument("-pz", "--puzzles", help="Puzzle file, text or binary bank", default=__PUZZLES)
+    parser.add_argument("-g", "--generators", help="Puzzle generator processes, 0 to only use the puzzle file",
+                        type=int, default=2)
+    parser.add_argument("-ps", "--pool-size", help="Number of generated puzzles kept ready", type=int, default=32)
+    parser.add_argument("--finished-ttl", help="Seconds a finished game is kept", type=float, default=FINISHED_TTL)
+    parser.add_argument("--empty-ttl", help="Seconds an empty game is kept", type=float, default=EMPTY_TTL)
+    parser.add_argument("--idle-ttl", help="Seconds a game without moves is kept", type=float, default=IDLE_TTL)
+    parser.add_argument("--lease", help="Seconds a client session survives without any call", type=float,
+                        default=_LEASE)
+    parser.add_argument("-sh", "--shards", help="Worker processes to spread the games over, 0 to keep them in this "
+                                                "process", type=int, default=0)
+    parser.add_argument("-ap", "--async-port", help="Also serve sessions over asyncio streams on this port, "
+                                                    "needs Python 3.7+ and no shards", type=int)
+    parser.add_argument("-r", "--replicate", help="Stream every change to backups connecting to this port",
+                        type=int)
+    parser.add_argument("-b", "--backup-of", help="Run as a backup of the servers replicating to these "
+                                                  "comma separated host:port addresses, in the order they take over")
+    parser.add_argument("-w", "--wal", help="Directory of the write-ahead log and snapshots, the state in it is "
+                                            "recovered at startup")
+    parser.add_argument("--fsync-interval", help="Seconds logged changes may wait for an fsync, 0 to fsync every "
+                                                 "batch", type=float, default=FSYNC_INTERVAL)
+    parser.add_argument("--wal-batch", help="Most changes written to the log at once", type=int, default=BATCH)
+    parser.add_argument("--snapshot-interval", help="Seconds between snapshots", type=float,
+                        default=SNAPSHOT_INTERVAL)
+    parser.add_argument("-tp", "--threadpool", help="Pyro worker threads of the server and of every shard, each "
+                                                    "connected client holds one and a client in a game two",
+                        type=int, default=_THREADPOOL)
+    parser.add_argument("-se", "--serializers", help="Comma separated serializers accepted from clients, the first "
+                                                     "is also used for calls to the shards. marshal needs the same "
+                                                     "Python version on both ends", default="serpent,json,marshal")
 
     args = parser.parse_args()
+    _LEASE = max(args.lease, _MAX_WAIT + 1)
+    if args.shards > 0 and (args.replicate or args.backup_of or args.wal):
+        parser.error("Sharded games cannot be replicated or logged")
+    if args.shards > 0 and args.async_port is not None:
+        # Calls to the shards block, they would stall the event loop of every async client
+        parser.error("Sharded games cannot be served over the async transport")
+    if args.wal and not os.path.isdir(args.wal):
+        os.makedirs(args.wal)
+    serializers = args.serializers.split(",")
+    for serializer in serializers:
+        try:
+            Pyro4.util.get_serializer(serializer)
+        except Pyro4.errors.SerializeError as e:
+            parser.error(str(e))
+    # Clients pick one of the accepted serializers and get their answers in it
+    Pyro4.config.SERIALIZERS_ACCEPTED = set(serializers)
+    Pyro4.config.SERIALIZER = serializers[0]
+    if args.threadpool < 1:
+        parser.error("The threadpool needs at least one thread")
+    # Set before the shards are started, they inherit it
+    Pyro4.config.THREADPOOL_SIZE = args.threadpool
+
+    # Load all the puzzles once, so creating a game does not touch the disk
+    puzzle_bank = PuzzleBank.load(args.puzzles)
+    LOG.info("Loaded %d puzzles from %s" % (len(puzzle_bank), args.puzzles))
+
+    ttls = (args.finished_ttl, args.empty_ttl, args.idle_ttl)
+    if args.shards > 0:
+        # Every worker process owns the games whose ids hash to it and generates puzzles of its own
+        _GAMES = ShardedGames.start(args.shards, args.host, puzzle_bank, args.generators, args.pool_size, ttls)
+    else:
+        # Generate fresh puzzles in the background, the bank covers for an empty pool
+        if args.generators > 0:
+            puzzle_source = PuzzlePool(puzzle_bank, args.pool_size, args.generators)
+            puzzle_source.start()
+        else:
+            puzzle_source = puzzle_bank
+        _GAMES = Games(puzzle_source, *ttls)
+
+    sudoku = CompetitiveSudoku()
+
+    if args.replicate or args.wal:
+        _GAMES.journal = publish
+    if args.replicate:
+        _REPLICATOR = Replicator(sudoku._snapshot, args.host, args.replicate)
+        _REPLICATOR.start()
+
+    if args.backup_of:
+        def start_following():
+            """
+            Starts over with empty games and sessions, to be filled from the server followed """
+            global _GAMES, _PLAYERS
+            _PLAYERS = Players()
+            _GAMES = Games(_GAMES.puzzles, *ttls)
+            if args.replicate or args.wal:
+                _GAMES.journal = publish
+            sudoku.users = StripedDict()
+            sudoku.sessions = StripedDict()
+            return sudoku._replay
+
+        # Mirror the primary until it and every backup ahead of this one have failed
+        wait_for_takeover([parse_address(address) for address in args.backup_of.split(",")], start_following)
+        LOG.info("Taking over with %d games and %d sessions" % (len(_GAMES.games), len(sudoku.sessions)))
+        sudoku._take_over()
+    elif args.wal:
+        # Pick up where the last run stopped: load the latest snapshot and replay the log written after it
+        started = time.time()
+        _, replayed = recover(args.wal, sudoku._replay)
+        LOG.info("Recovered %d games and %d sessions from %d logged changes in %.2fs" %
+                 (len(_GAMES.games), len(sudoku.sessions), replayed, time.time() - started))
+        sudoku._take_over()
+
+    if args.wal:
+        # Log from a new segment on, the first snapshot taken right away makes the recovered log redundant
+        _WAL = WriteAheadLog(args.wal, next_sequence(args.wal), sudoku._snapshot, args.fsync_interval,
+                             args.wal_batch, args.snapshot_interval)
+        _WAL.start()
+
+    if args.shards == 0:
+        _GAMES.reaper.start()
 
     # Make a Pyro daemon
     daemon = Pyro4.Daemon(host=args.host, port=args.port)
 
     # Register the Sudoku game with Pyro
-    sudoku = CompetitiveSudoku()
     uri = daemon.register(sudoku)
+    sudoku.sessions_reaper.start()
+
+    # Serve the same sessions to clients of the asyncio transport, without a thread per connection
+    if args.async_port is not None:
+        from async_transport import AsyncTransport
+        AsyncTransport(sudoku, args.host, args.async_port, _MAX_WAIT).start()
 
     LOG.info("The game URI is: " + str(uri))
 
-    # Broadcast the URI of the Pyro server instance
+    # Announce the server and its load to the multicast group
     mc_host = args.multicast
     mc_port = args.mcport
     server_name = args.name
 
-    mc_thread = threading.Thread(target=sudoku_uri_multicast, args=(uri, (mc_host, mc_port), server_name))
-    mc_thread.setDaemon(True)
-    mc_thread.start()
+    announcer = Announcer(uri, server_name, (mc_host, mc_port), _GAMES.get_load, _LATENCY)
+    announcer.start()
 
     daemon.requestLoop()
@@ -0,0 +1,411 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    from Queue import LifoQueue
+except ImportError:
+    from queue import LifoQueue
+
+import Pyro4
+
+from games import Games, MAX_PAGE, LOBBY_FULL, LOBBY_UNCHANGED
+from generator import PuzzlePool
+from registry import IdAllocator, decode_id
+
+LOG = logging.getLogger()
+
+SHARD_CONNECTIONS = 8  # Connections the router keeps to every shard, calls beyond that wait for a free one
+POLL_SLICE = 0.5  # Longest a router's long-poll of a shard lasts, games waited on meanwhile are added after it
+WATCH_LINGER = 5.0  # Seconds a game stays watched after its last waiter, covering the gap until the next wait
+
+
+def shard_of(game_id, shards):
+    """
+    Returns the index of the shard owning the game, ids counting up take turns between the shards
+    :param game_id: id of the game
+    :param shards: number of shards
+    :raise KeyError: if the id cannot be the id of a game
+    """
+    try:
+        return decode_id(game_id) % shards
+    except ValueError:
+        raise KeyError(game_id)
+
+
+@Pyro4.expose
+class Shard(object):
+    """
+    Games of one worker process, served to the router over Pyro
+    """
+
+    def __init__(self, games):
+        self.games = games
+
+    def create_game(self, game_id, max_players, player_id, name):
+        return self.games.create_game(max_players, player_id, name, game_id)
+
+    def add_player(self, game_id, player_id, name):
+        return self.games.get_game(game_id).add_player(player_id, name)
+
+    def remove_player(self, game_id, player_id):
+        game = self.games.games.get(game_id)
+        if game is not None:  # Already evicted otherwise
+            game.remove_player(player_id)
+
+    def make_move(self, game_id, user_id, x, y, value):
+        return self.games.get_game(game_id).make_move(user_id, x, y, value)
+
+    def make_moves(self, game_id, user_id, moves):
+        return self.games.get_game(game_id).make_moves(user_id, moves)
+
+    def get_state(self, game_id):
+        return self.games.get_game(game_id).get_state()
+
+    def get_state_since(self, game_id, version):
+        return self.games.get_game(game_id).get_state_since(version)
+
+    def wait_for_changes(self, versions, timeout):
+        """
+        Blocks until any of the games moves past the version given for it or the timeout expires
+        :param versions: {game_id: last version seen}
+        :param timeout: maximum number of seconds to wait
+        :return: {game_id: get_state_since the given version} of the games that moved on, None for games that are
+        gone
+        """
+        changed = threading.Event()
+        watched = []
+        moved = {}
+
+        def watcher(_):
+            changed.set()
+
+        for game_id, version in versions.items():
+            game = self.games.games.get(game_id)
+            if game is None:
+                moved[game_id] = None
+            elif game.watch(version, watcher):
+                watched.append((game_id, game))
+            else:
+                moved[game_id] = game.get_state_since(version)
+        if not moved:
+            changed.wait(timeout)
+        for game_id, game in watched:
+            game.unwatch(watcher)
+            if game.version != versions[game_id]:
+                moved[game_id] = game.get_state_since(versions[game_id])
+        return moved
+
+    def list_games(self, cursor, limit, filters):
+        return self.games.list_games(cursor, limit, filters)
+
+    def get_tuple(self):
+        return self.games.get_tuple()
+
+    def get_lobby_version(self):
+        return self.games.lobby_version
+
+    def get_load(self):
+        return self.games.get_load()
+
+    def get_metrics(self):
+        return {"puzzles": self.games.puzzles.get_metrics(), "games": self.games.get_metrics()}
+
+
+def _exit_with_parent(parent_pid):
+    """
+    Stops the worker once the process that started it is gone
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def _run_shard(index, host, puzzle_bank, generators, pool_size, ttls, uris):
+    """
+    Entry point of a worker process, serves a Games object of its own until the parent exits
+    """
+    watchdog = threading.Thread(target=_exit_with_parent, args=(os.getppid(),))
+    watchdog.setDaemon(True)
+    watchdog.start()
+
+    if generators > 0:
+        puzzle_source = PuzzlePool(puzzle_bank, pool_size, generators)
+        puzzle_source.start()
+    else:
+        puzzle_source = puzzle_bank
+    games = Games(puzzle_source, *ttls)
+    games.reaper.start()
+
+    daemon = Pyro4.Daemon(host=host)
+    uris.put((index, str(daemon.register(Shard(games)))))
+    daemon.requestLoop()
+
+
+class RemoteGame(object):
+    """
+    Stands in for a Game living in a shard, forwarding the calls the User makes on its game
+    """
+
+    def __init__(self, sharded_games, shard, game_id):
+        self.sharded_games = sharded_games
+        self.shard = shard
+        self.game_id = game_id
+
+    def __call(self, method, *args):
+        return self.sharded_games.pools[self.shard].call(method, self.game_id, *args)
+
+    def add_player(self, player_id, name):
+        return self.__call("add_player", player_id, name)
+
+    def remove_player(self, player_id):
+        return self.__call("remove_player", player_id)
+
+    def make_move(self, user_id, x, y, value):
+        return self.__call("make_move", user_id, x, y, value)
+
+    def make_moves(self, user_id, moves):
+        return self.__call("make_moves", user_id, moves)
+
+    def get_state(self):
+        return self.__call("get_state")
+
+    def get_state_since(self, version):
+        return self.__call("get_state_since", version)
+
+    def wait_for_change(self, version, timeout):
+        state = self.sharded_games.watchers[self.shard].wait(self.game_id, version, timeout)
+        return state if state is not None else self.get_state_since(version)
+
+
+class ConnectionPool(object):
+    """
+    Bounded set of connections to a shard, lent to one call at a time.
+    Every connection holds a worker thread of the shard, so the router's threads share a few of them instead of
+    each keeping its own.
+    """
+
+    def __init__(self, uri, size=SHARD_CONNECTIONS):
+        """
+        :param uri: Pyro URI of the shard
+        :param size: most connections opened
+        """
+        self.uri = uri
+        # Most recently returned first, so the same few connections stay in use under light load.
+        # Connections are opened when first lent, None stands for one not opened yet.
+        self.idle = LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def call(self, method, *args):
+        """
+        Calls a method of the shard on a free connection, waiting for one if they are all in use
+        """
+        proxy = self.idle.get()
+        try:
+            if proxy is None:
+                proxy = Pyro4.Proxy(self.uri)
+            return getattr(proxy, method)(*args)
+        finally:
+            self.idle.put(proxy)
+
+
+class ShardWatcher(threading.Thread):
+    """
+    Waits for changes to all the games of one shard that clients of the router wait on, with a single long-poll
+    at a time. Waiting clients hold a thread of the router only, so the shard's threads stay free for moves.
+    """
+
+    def __init__(self, uri):
+        """
+        :param uri: Pyro URI of the shard
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.uri = uri
+        self.lock = threading.Lock()
+        # Wakes the poller up when there are games to watch
+        self.watching = threading.Condition(self.lock)
+        # Latest version seen of every watched game, None once the game is gone
+        self.versions = {}
+        # One condition per watched game, so a move only wakes the clients waiting on its game
+        self.changed = {}
+        # Latest answer of the shard for every watched game, as (version it was asked from, state since then)
+        self.states = {}
+        # Number of clients waiting on every watched game and since when nobody has
+        self.waiters = {}
+        self.idle_since = {}
+
+    def wait(self, game_id, version, timeout):
+        """
+        Blocks until the game moves past the given version or the timeout expires
+        :return: the changes since the version if the shard sent them while watching from the same version, None
+        if they have to be asked for
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            changed = self.changed.get(game_id)
+            if changed is None:
+                changed = self.changed[game_id] = threading.Condition(self.lock)
+                self.versions[game_id] = version
+                self.watching.notify()
+            elif self.versions[game_id] is not None and self.versions[game_id] < version:
+                self.versions[game_id] = version
+            self.waiters[game_id] = self.waiters.get(game_id, 0) + 1
+            self.idle_since.pop(game_id, None)
+            try:
+                while self.versions[game_id] == version:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    changed.wait(remaining)
+                state = self.states.get(game_id)
+                return state[1] if state is not None and state[0] == version else None
+            finally:
+                self.waiters[game_id] -= 1
+                if self.waiters[game_id] == 0:
+                    del self.waiters[game_id]
+                    self.idle_since[game_id] = time.time()
+
+    def __forget_idle(self):
+        now = time.time()
+        for game_id, since in list(self.idle_since.items()):
+            if since + WATCH_LINGER < now:
+                del self.idle_since[game_id]
+                del self.versions[game_id]
+                del self.changed[game_id]
+                self.states.pop(game_id, None)
+
+    def run(self):
+        # A connection of its own, the long-polls would otherwise take turns with the calls for a pooled one
+        proxy = Pyro4.Proxy(self.uri)
+        while True:
+            with self.lock:
+                self.__forget_idle()
+                while not self.versions:
+                    self.watching.wait()
+                versions = dict((game_id, version) for game_id, version in self.versions.items()
+                                if version is not None)
+            try:
+                moved = proxy.wait_for_changes(versions, POLL_SLICE)
+            except Exception as e:
+                LOG.error("Cannot watch the games of shard %s: %s" % (self.uri, str(e)))
+                time.sleep(POLL_SLICE)
+                continue
+            with self.lock:
+                for game_id, state in moved.items():
+                    if game_id in self.versions:
+                        self.versions[game_id] = state[1] if state is not None else None
+                        self.states[game_id] = (versions[game_id], state) if state is not None else None
+                        self.changed[game_id].notify_all()
+
+
+class ShardedGames(object):
+    """
+    Router spreading the games over worker processes, so game logic is not held back by a single interpreter lock.
+    Every game lives in the shard picked by the hash of its id. Offers the parts of the Games interface the
+    server uses: games are handed out as RemoteGame objects and the lobby is merged from all the shards.
+    """
+
+    def __init__(self, uris):
+        """
+        :param uris: Pyro URIs of the shards, in shard order
+        """
+        self.uris = uris
+        self.ids = IdAllocator()
+        # Long-polls of the clients are answered here, from one long-poll of every shard
+        self.watchers = [ShardWatcher(uri) for uri in uris]
+        for watcher in self.watchers:
+            watcher.start()
+        self.pools = [ConnectionPool(uri) for uri in uris]
+
+    @classmethod
+    def start(cls, shards, host, puzzle_bank, generators, pool_size, ttls):
+        """
+        Starts the worker processes and waits until they all serve their games
+        :param shards: number of worker processes
+        :param host: address the workers listen on
+        :param puzzle_bank: puzzles the workers draw their boards from
+        :param generators: puzzle generator processes per worker, 0 to only use the bank
+        :param pool_size: generated puzzles each worker keeps ready
+        :param ttls: (finished_ttl, empty_ttl, idle_ttl) of the games
+        :return: the router
+        """
+        uris = multiprocessing.Queue()
+        for index in range(shards):
+            # Not daemonic, so the workers may start puzzle generators of their own
+            worker = multiprocessing.Process(target=_run_shard, name="shard-%d" % index,
+                                             args=(index, host, puzzle_bank, generators, pool_size, ttls, uris))
+            worker.start()
+
+        ordered = [None] * shards
+        for _ in range(shards):
+            index, uri = uris.get()
+            ordered[index] = uri
+        LOG.info("Started %d game shards" % shards)
+        return cls(ordered)
+
+    def create_game(self, max_players, player_id, name):
+        game_id = self.ids.allocate()
+        shard = shard_of(game_id, len(self.uris))
+        return self.pools[shard].call("create_game", game_id, max_players, player_id, name)
+
+    def get_game(self, game_id):
+        return RemoteGame(self, shard_of(game_id, len(self.uris)), game_id)
+
+    def remove_player_from_game(self, game_id, player_id):
+        self.get_game(game_id).remove_player(player_id)
+
+    def lobby_version(self):
+        """
+        Returns the sum of the shards' lobby versions, it grows whenever any of them does
+        """
+        return sum(self.pools[shard].call("get_lobby_version") for shard in range(len(self.uris)))
+
+    def get_tuple(self):
+        rows = []
+        for shard in range(len(self.uris)):
+            rows.extend(self.pools[shard].call("get_tuple"))
+        return rows
+
+    def get_changes(self, version=None):
+        """
+        Same as Games.get_changes, except that the shards' diffs cannot be merged, so any change sends the full
+        lobby
+        """
+        lobby_version = self.lobby_version()
+        if version is not None and int(version) == lobby_version:
+            return [LOBBY_UNCHANGED, lobby_version]
+        return [LOBBY_FULL, lobby_version, self.get_tuple()]
+
+    def list_games(self, cursor=None, limit=MAX_PAGE, filters=None, version=None):
+        """
+        Same as Games.list_games, pages go through the shards one after the other.
+        The cursor is [shard, cursor within the shard].
+        """
+        limit = min(max(int(limit), 1), MAX_PAGE)
+        lobby_version = self.lobby_version()
+        if version is not None and int(version) == lobby_version:
+            return [None, None, lobby_version]
+
+        shard, shard_cursor = cursor if cursor is not None else (0, None)
+        output = []
+        while shard < len(self.uris) and len(output) < limit:
+            rows, shard_cursor, _ = self.pools[shard].call("list_games", shard_cursor, limit - len(output), filters)
+            output.extend(rows)
+            if shard_cursor is None:
+                shard += 1
+        next_cursor = [shard, shard_cursor] if shard < len(self.uris) else None
+        return [output, next_cursor, lobby_version]
+
+    def get_load(self):
+        loads = [self.pools[shard].call("get_load") for shard in range(len(self.uris))]
+        return tuple(sum(column) for column in zip(*loads))
+
+    def get_metrics(self):
+        """
+        Returns the metrics of every shard
+        """
+        return [self.pools[shard].call("get_metrics") for shard in range(len(self.uris))]
@@ -0,0 +1,137 @@
+import random
+import sys
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+
+from game import Game
+from games import Games
+from puzzles import PuzzleBank
+
+__DESC = "Hammers the Games registry and Game objects from many threads and checks they stay consistent"
+
+
+def play(games, player_id, deadline, errors, stats):
+    """
+    Creates or joins games, makes random moves in them and leaves, until the deadline.
+    """
+    rng = random.Random(player_id)
+    try:
+        while time.time() < deadline:
+            listed = games.get_tuple()
+            if listed and rng.random() < 0.7:
+                game_id = rng.choice(listed)[0]
+                try:
+                    game = games.get_game(game_id)
+                except KeyError:
+                    continue  # Removed after it was listed
+                if not game.add_player(player_id, player_id):
+                    continue
+            else:
+                game_id = games.create_game(rng.randint(2, 4), player_id, player_id)
+                game = games.get_game(game_id)
+
+            for _ in range(rng.randint(1, 40)):
+                x, y = rng.randrange(9), rng.randrange(9)
+                if rng.random() < 0.8:
+                    value = game.solution.get(x, y)
+                else:
+                    value = rng.randint(1, 9)
+                game.make_move(player_id, x, y, value)
+                game.get_state_since(rng.randint(0, game.version))
+                stats[player_id] += 1
+
+            games.remove_player_from_game(game_id, player_id)
+    except Exception:
+        errors.append(traceback.format_exc())
+
+
+def check_game(game_id, game):
+    """
+    Returns a list of broken invariants of a single game.
+    """
+    problems = []
+    mismatches = 0
+    for x in range(9):
+        for y in range(9):
+            value = game.board.get(x, y)
+            if value != game.solution.get(x, y):
+                mismatches += 1
+                if value != 0:
+                    problems.append("%s: wrong digit at %d,%d" % (game_id, x, y))
+    if mismatches != game.remaining:
+        problems.append("%s: %d cells left but counter says %d" % (game_id, mismatches, game.remaining))
+
+    scores = [entry[1] for entry in game.leaderboard]
+    if scores != sorted(scores, reverse=True):
+        problems.append("%s: leaderboard out of order" % game_id)
+    if sorted((entry[2], entry[1]) for entry in game.leaderboard) != sorted(game.scores.items()):
+        problems.append("%s: leaderboard does not match the scores" % game_id)
+    if any(game.ranks[entry[2]] != rank for rank, entry in enumerate(game.leaderboard)):
+        problems.append("%s: ranks do not match the leaderboard" % game_id)
+    if game.names_scores != [tuple(entry) for entry in game.leaderboard]:
+        problems.append("%s: handed out scoreboard is stale" % game_id)
+
+    versions = [change[0] for change in game.history]
+    if versions != sorted(set(versions)) or (versions and versions[-1] > game.version):
+        problems.append("%s: history versions are not increasing" % game_id)
+    if game.removed:
+        problems.append("%s: removed game is still registered" % game_id)
+    return problems
+
+
+def check_batches(puzzles):
+    """
+    Returns a list of broken invariants of a batch of moves with a bad move after a good one.
+    The whole batch has to be rejected without changing the game.
+    """
+    game = Game(2, puzzles.get(0))
+    game.add_player("player", "player")
+    x, y = next((x, y) for x in range(9) for y in range(9) if game.board.get(x, y) == 0)
+    journaled = []
+    game.journal = lambda *event: journaled.append(event)
+    before = (game.version, game.remaining, dict(game.scores), game.board.encode())
+
+    problems = []
+    try:
+        game.make_moves("player", [(x, y, game.solution.get(x, y)), (99, 0, 1)])
+        problems.append("batch with a bad move was accepted")
+    except ValueError:
+        pass
+    if (game.version, game.remaining, dict(game.scores), game.board.encode()) != before:
+        problems.append("rejected batch changed the game")
+    if journaled:
+        problems.append("rejected batch was journaled")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__DESC)
+    parser.add_argument("-t", "--threads", help="Number of player threads", type=int, default=32)
+    parser.add_argument("-s", "--seconds", help="How long to run", type=float, default=5)
+    parser.add_argument("-pz", "--puzzles", help="Puzzle file", default="solutions.txt")
+    args = parser.parse_args()
+
+    puzzles = PuzzleBank.load(args.puzzles)
+    games = Games(puzzles)
+    errors = []
+    stats = dict(("player-%d" % i, 0) for i in range(args.threads))
+    deadline = time.time() + args.seconds
+
+    threads = [threading.Thread(target=play, args=(games, player_id, deadline, errors, stats))
+               for player_id in stats]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    problems = list(errors) + check_batches(puzzles)
+    for game_id, game in games.games.items():
+        problems.extend(check_game(game_id, game))
+
+    print("%d moves in %d threads, %d games left, %d problems" %
+          (sum(stats.values()), args.threads, games.get_nr_games(), len(problems)))
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+LOG = logging.getLogger()
+
+FSYNC_INTERVAL = 0.05  # Seconds written events may wait for an fsync, 0 to fsync every batch
+BATCH = 512  # Most events written in one go
+SNAPSHOT_INTERVAL = 300  # Seconds between snapshots
+ROTATE_TIMEOUT = 10  # Seconds a rotation may take before the writer is considered stuck
+
+_SEGMENT = "wal-%08d.jsonl"
+_SNAPSHOT = "snapshot-%08d.json"
+_NUMBERED = re.compile(r"^(wal|snapshot)-(\d{8})\.jsonl?$")
+_ROTATE = None  # Queued to make the writer start the next segment
+
+
+def _numbered(directory, kind):
+    """
+    Returns the sequence numbers of the segments or snapshots in the directory, lowest first
+    :param kind: "wal" or "snapshot"
+    """
+    numbers = []
+    for name in os.listdir(directory):
+        match = _NUMBERED.match(name)
+        if match and match.group(1) == kind:
+            numbers.append(int(match.group(2)))
+    return sorted(numbers)
+
+
+def next_sequence(directory):
+    """
+    Returns the sequence number for a new segment, past every segment and snapshot in the directory
+    """
+    return max(_numbered(directory, "wal") + _numbered(directory, "snapshot") + [0]) + 1
+
+
+def recover(directory, apply_event):
+    """
+    Loads the latest snapshot and replays the segments written after it.
+    A torn last line, left by a crash in the middle of a write, ends the replay of its segment.
+    :param directory: directory of the log
+    :param apply_event: callback applying an event
+    :return: (sequence number for the next segment, number of events replayed)
+    """
+    snapshots = _numbered(directory, "snapshot")
+    segments = _numbered(directory, "wal")
+    start = snapshots[-1] if snapshots else 0
+    replayed = 0
+
+    if snapshots:
+        with open(os.path.join(directory, _SNAPSHOT % start), "rb") as snapshot:
+            for event in json.loads(snapshot.read().decode("utf-8")):
+                apply_event(event)
+                replayed += 1
+
+    for seq in segments:
+        if seq < start:
+            continue
+        with open(os.path.join(directory, _SEGMENT % seq), "rb") as segment:
+            for line in segment:
+                try:
+                    event = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    LOG.warning("Torn write at the end of %s" % (_SEGMENT % seq))
+                    break
+                apply_event(event)
+                replayed += 1
+
+    return next_sequence(directory), replayed
+
+
+class WriteAheadLog(threading.Thread):
+    """
+    Append-only log of events, written by a thread of its own in batches.
+    Events queued while a batch is written go out together in the next one and fsyncs are spread out over
+    fsync_interval, so callers never wait for the disk. An event is durable at most fsync_interval after
+    it was appended.
+    If the disk fails, the writer stops and every later append or rotation raises IOError, so changes are not
+    acknowledged any more once they can no longer be made durable.
+    The log is split into numbered segments. A snapshot numbered N holds everything before segment N,
+    so older segments and snapshots can be deleted once it is written.
+    """
+
+    def __init__(self, directory, seq, snapshot, fsync_interval=FSYNC_INTERVAL, batch=BATCH,
+                 snapshot_interval=SNAPSHOT_INTERVAL):
+        """
+        :param directory: directory of the log
+        :param seq: sequence number of the first segment to write, see next_sequence
+        :param snapshot: callable returning the current state as a list of events
+        :param fsync_interval: seconds written events may wait for an fsync
+        :param batch: most events written in one go
+        :param snapshot_interval: seconds between snapshots
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.directory = directory
+        self.seq = seq
+        self.snapshot = snapshot
+        self.fsync_interval = fsync_interval
+        self.batch = batch
+        self.snapshot_interval = snapshot_interval
+        self.pending = Queue()
+        self.rotated = threading.Event()
+        self.segment = open(os.path.join(directory, _SEGMENT % seq), "ab")
+        self.appended = 0
+        self.batches = 0
+        self.fsyncs = 0
+        # Error that stopped the writer, None while it works
+        self.failure = None
+
+    def append(self, event):
+        """
+        Queues an event for writing, never blocks
+        :param event: JSON serializable list starting with the kind of the event
+        :raise IOError: if the writer has failed
+        """
+        self.check()
+        self.pending.put((json.dumps(event) + "\n").encode("utf-8"))
+
+    def check(self):
+        """
+        :raise IOError: if the log has failed, changes made now could not be recovered
+        """
+        if self.failure is not None:
+            raise IOError("The write-ahead log has failed: %s" % str(self.failure))
+
+    def run(self):
+        snapshotter = threading.Thread(target=self.__snapshot_loop)
+        snapshotter.setDaemon(True)
+        snapshotter.start()
+
+        try:
+            self.__write_loop()
+        except (IOError, OSError) as e:
+            LOG.error("The write-ahead log has failed, changes are no longer accepted: %s" % str(e))
+            self.failure = e
+            # Wake up a rotation waiting for the writer, it fails now
+            self.rotated.set()
+
+    def __write_loop(self):
+        last_sync = time.time()
+        unsynced = False
+        while True:
+            # Wait for events, but no longer than until the written ones are due for an fsync
+            timeout = max(last_sync + self.fsync_interval - time.time(), 0) if unsynced else None
+            lines = []
+            try:
+                lines.append(self.pending.get(timeout=timeout))
+                while len(lines) < self.batch:
+                    lines.append(self.pending.get_nowait())
+            except Empty:
+                pass
+
+            rotate = _ROTATE in lines
+            data = b"".join(line for line in lines if line is not _ROTATE)
+            if data:
+                self.segment.write(data)
+                self.segment.flush()
+                self.appended += len(lines) - lines.count(_ROTATE)
+                self.batches += 1
+                unsynced = True
+            if unsynced and (rotate or time.time() >= last_sync + self.fsync_interval):
+                os.fsync(self.segment.fileno())
+                self.fsyncs += 1
+                last_sync = time.time()
+                unsynced = False
+            if rotate:
+                self.segment.close()
+                self.seq += 1
+                self.segment = open(os.path.join(self.directory, _SEGMENT % self.seq), "ab")
+                self.rotated.set()
+
+    def rotate(self):
+        """
+        Makes the writer move on to the next segment, returns the sequence number of the new segment once it has.
+        Everything appended before belongs to the older segments.
+        :raise IOError: if the writer has failed or does not get to the rotation within ROTATE_TIMEOUT
+        """
+        self.check()
+        self.rotated.clear()
+        self.pending.put(_ROTATE)
+        if not self.rotated.wait(ROTATE_TIMEOUT):
+            raise IOError("The write-ahead log did not rotate within %d seconds" % ROTATE_TIMEOUT)
+        self.check()
+        return self.seq
+
+    def take_snapshot(self):
+        """
+        Writes a snapshot of the current state and deletes the segments and snapshots it makes redundant
+        """
+        seq = self.rotate()
+        events = self.snapshot()
+        path = os.path.join(self.directory, _SNAPSHOT % seq)
+        with open(path + ".tmp", "wb") as snapshot:
+            snapshot.write(json.dumps(events).encode("utf-8"))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(path + ".tmp", path)
+
+        for old in _numbered(self.directory, "wal"):
+            if old < seq:
+                os.remove(os.path.join(self.directory, _SEGMENT % old))
+        for old in _numbered(self.directory, "snapshot"):
+            if old < seq:
+                os.remove(os.path.join(self.directory, _SNAPSHOT % old))
+        LOG.info("Wrote snapshot %d with %d events" % (seq, len(events)))
+
+    def __snapshot_loop(self):
+        while True:
+            try:
+                self.take_snapshot()
+            except (IOError, OSError) as e:
+                LOG.error("Cannot write a snapshot: %s" % str(e))
+            time.sleep(self.snapshot_interval)
+
+    def get_metrics(self):
+        """
+        Returns how much has been written and how well it was batched
+        """
+        return {
+            "segment": self.seq,
+            "appended": self.appended,
+            "batches": self.batches,
+            "fsyncs": self.fsyncs,
+            "queued": self.pending.qsize(),
+            "failure": str(self.failure) if self.failure is not None else None,
+        }